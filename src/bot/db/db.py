@@ -1,3 +1,4 @@
+import json
 import logging
 import sqlite3
 
@@ -81,6 +82,19 @@ async def get_user_email(user_id) -> str | None:
             return row[0] if row and row[0] else None
 
 
+async def get_user_emails(user_ids: list[int]) -> dict[int, str]:
+    """ Emails of the users who have one, with one query. """
+    if not user_ids:
+        return {}
+    placeholders = ', '.join('?' * len(user_ids))
+    async with aiosqlite.connect(config.db_path) as db:
+        async with db.execute(
+            f"SELECT user_id, email FROM users WHERE user_id IN ({placeholders}) AND email IS NOT NULL AND email != ''",
+            user_ids
+        ) as cursor:
+            return {user_id: email for user_id, email in await cursor.fetchall()}
+
+
 # =========================
 # TOURS
 # =========================
@@ -186,3 +200,93 @@ async def delete_tour_from_db(tour_id: int) -> None:
         )
         await db.commit()
 
+
+
+# =========================
+# PENDING RECORDS
+# =========================
+async def _create_pending_table(db: aiosqlite.Connection) -> None:
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS pending_records (
+        record_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id BIGINT NOT NULL,
+        record TEXT NOT NULL,
+        highlight INTEGER DEFAULT 0,
+        status VARCHAR(10) DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        last_error TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        committed_at TEXT
+    )
+    """)
+
+
+async def add_pending_record(user_id: int, record_data: list, highlight: bool = False) -> int:
+    """ Queues a record for writing to Google Sheets. Returns its id. """
+    async with aiosqlite.connect(config.db_path) as db:
+        await _create_pending_table(db)
+        cursor = await db.execute(
+            'INSERT INTO pending_records (user_id, record, highlight) VALUES (?, ?, ?)',
+            (user_id, json.dumps(record_data, ensure_ascii=False), int(highlight))
+        )
+        await db.commit()
+        return cursor.lastrowid
+
+
+async def get_pending_records(limit: int = 50) -> list[tuple[int, int, list, bool, int, bool]]:
+    """
+    Returns (record_id, user_id, record_data, highlight, attempts, uncertain) of the queued records, oldest first.
+    A record is uncertain if a write of it was started but not confirmed: it may already be in the sheet.
+    """
+    async with aiosqlite.connect(config.db_path) as db:
+        await _create_pending_table(db)
+        cursor = await db.execute(
+            "SELECT record_id, user_id, record, highlight, attempts, status FROM pending_records "
+            "WHERE status IN ('pending', 'writing') ORDER BY record_id LIMIT ?",
+            (limit,)
+        )
+        rows = await cursor.fetchall()
+        return [(record_id, user_id, json.loads(record), bool(highlight), attempts, status == 'writing')
+                for record_id, user_id, record, highlight, attempts, status in rows]
+
+
+async def mark_records_writing(record_ids: list[int]) -> None:
+    """ Marks records as being written, until the write is confirmed or has surely failed. """
+    async with aiosqlite.connect(config.db_path) as db:
+        await db.executemany(
+            "UPDATE pending_records SET status = 'writing' WHERE record_id = ?",
+            [(record_id,) for record_id in record_ids]
+        )
+        await db.commit()
+
+
+async def mark_records_committed(record_ids: list[int]) -> None:
+    async with aiosqlite.connect(config.db_path) as db:
+        await db.executemany(
+            "UPDATE pending_records SET status = 'done', committed_at = CURRENT_TIMESTAMP WHERE record_id = ?",
+            [(record_id,) for record_id in record_ids]
+        )
+        await db.commit()
+
+
+async def mark_records_attempted(record_ids: list[int], error: str, uncertain: bool = False) -> None:
+    """
+    Records a failed attempt: the records stay in the queue. Uncertain records
+    may have been written despite the error and are looked for in the sheet before the next write.
+    """
+    async with aiosqlite.connect(config.db_path) as db:
+        await db.executemany(
+            'UPDATE pending_records SET attempts = attempts + 1, last_error = ?, status = ? WHERE record_id = ?',
+            [(error, 'writing' if uncertain else 'pending', record_id) for record_id in record_ids]
+        )
+        await db.commit()
+
+
+async def mark_records_failed(record_ids: list[int], error: str) -> None:
+    """ Removes records that can never be written from the queue. """
+    async with aiosqlite.connect(config.db_path) as db:
+        await db.executemany(
+            "UPDATE pending_records SET status = 'failed', last_error = ? WHERE record_id = ?",
+            [(error, record_id) for record_id in record_ids]
+        )
+        await db.commit()
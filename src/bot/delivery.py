@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from collections import Counter, defaultdict
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+logger = logging.getLogger(__name__)
+
+# Telegram limits: about 30 messages per second for the bot, about one per second for a chat with short bursts
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+# Messages being sent at the same time
+MAX_CONCURRENCY = 10
+
+MAX_ATTEMPTS = 4
+# Delay after a network or server error, doubled after each failure
+RETRY_DELAY = 1.0
+
+
+class TokenBucket:
+    """ Token bucket for asyncio: waiters get tokens in the order they came. """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep(max(self._blocked_until - now, (1 - self._tokens) / self.rate))
+
+    def pause(self, delay: float) -> None:
+        """ No tokens for the delay, e.g. after a flood control error. """
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        self._tokens = 0.0
+
+
+class Delivery:
+    """
+    Sends bot messages within Telegram's limits.
+
+    Messages go out concurrently, but no more than MAX_CONCURRENCY at a time and within the global rate.
+    Messages to one chat are sent one by one, in order, within the chat's rate.
+    On a flood control error all sending waits for the time given by Telegram, and the message is repeated.
+    """
+
+    def __init__(self, rate: float, concurrency: int):
+        self._bucket = TokenBucket(rate, capacity=int(rate))
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chat_buckets: dict[int, TokenBucket] = defaultdict(lambda: TokenBucket(CHAT_RATE, CHAT_BURST))
+        self._chat_locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._stats = Counter()
+
+    async def send(self, bot: Bot, chat_id: int, text: str, **kwargs) -> bool:
+        """ Sends a message with bot.send_message. Returns False if it could not be delivered. """
+        async with self._chat_locks[chat_id]:
+            for attempt in range(MAX_ATTEMPTS):
+                await self._chat_buckets[chat_id].acquire()
+                async with self._semaphore:
+                    await self._bucket.acquire()
+                    try:
+                        await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                        self._stats['sent'] += 1
+                        return True
+                    except TelegramRetryAfter as e:
+                        delay = e.retry_after
+                        # Flood control applies to the whole bot
+                        self._bucket.pause(delay)
+                        logger.warning(f'Flood control for {chat_id}: retry in {delay} s')
+                    except (TelegramNetworkError, TelegramServerError) as e:
+                        delay = RETRY_DELAY * 2 ** attempt
+                        logger.warning(f'Error while sending a message to {chat_id}, retry in {delay} s: {e}')
+                    except Exception as e:
+                        # Blocked bot, wrong chat or message: repeating won't help
+                        logger.error(f'Message to {chat_id} is not delivered: {e}')
+                        self._stats['failed'] += 1
+                        return False
+
+                if attempt < MAX_ATTEMPTS - 1:
+                    self._stats['retries'] += 1
+                    await asyncio.sleep(delay)
+
+        logger.error(f'Message to {chat_id} is not delivered after {MAX_ATTEMPTS} attempts')
+        self._stats['failed'] += 1
+        return False
+
+    async def fan_out(self, bot: Bot, messages: list[tuple[int, str]], **kwargs) -> dict:
+        """
+        Sends messages (chat ID, text) to many chats at once and logs the throughput.
+        Returns the number of sent messages, the chats that didn't get theirs and the time taken.
+        """
+        start = time.monotonic()
+        results = await asyncio.gather(*(self.send(bot, chat_id, text, **kwargs) for chat_id, text in messages))
+
+        seconds = time.monotonic() - start
+        failed = [chat_id for (chat_id, _), delivered in zip(messages, results) if not delivered]
+        sent = len(messages) - len(failed)
+        logger.info(f'Delivered {sent} of {len(messages)} messages in {seconds:.1f} s '
+                    f'({sent / seconds if seconds else sent:.1f} msg/s), failed: {failed or "none"}')
+        return {'sent': sent, 'failed': failed, 'seconds': seconds}
+
+    def stats(self) -> dict[str, int]:
+        """ Counters of messages since the start. """
+        return dict(self._stats)
+
+
+# All bulk messages of the bot go through here
+delivery = Delivery(GLOBAL_RATE, MAX_CONCURRENCY)
@@ -11,7 +11,8 @@ from src.bot.filters import IsAdminOrGuide, is_admin, is_guide, is_superadmin
 from src.bot.keyboards.calendar import generate_calendar
 from src.bot.keyboards.pagination_kb import create_pagination_keyboard
 from src.bot.texts.staff_texts import buttons, replies, tour_texts
-from src.googlesheets.tours_filtering import filter_by_date, filter_for_sa_date
+from src.googlesheets.async_sheets import find_tours
+from src.googlesheets.tours_filtering import TourQuery
 
 router = Router()
 router.message.filter(IsAdminOrGuide())
@@ -94,20 +95,25 @@ async def handle_near_tours(callback: CallbackQuery, state: FSMContext):
         try:
             # Search for tours from Google Sheets for admins
             if is_superadmin(user_id):
-                tours, errors = filter_for_sa_date(orders_date)
+                query = TourQuery.for_date(orders_date, superadmin=True)
             elif is_admin(user_id):
-                tours, errors = filter_by_date(orders_date)
+                query = TourQuery.for_date(orders_date)
             # Search for tours from Google Sheets for guides
             elif is_guide(user_id):
-                tours, errors = filter_by_date(orders_date, guide=user_id)
+                query = TourQuery.for_date(orders_date, guide=user_id)
             else:
                 await callback.answer("У вас нет прав для выполнения этой команды.")
                 return
+            tours, errors, data_time = await find_tours(query)
         except Exception as e:
             logger.error(f"Error during tour filtering for user {user_id}: {e}")
             await callback.message.answer("Произошла ошибка при обработке вашего запроса. Попробуйте позже.")
             return
 
+        # The sheets couldn't be refreshed: warn that the data may be out of date
+        if data_time:
+            await callback.message.answer(replies['stale_data'].format(time=data_time))
+
         if not tours and not errors:
             await callback.message.answer(replies['no_excursions'])
             return
@@ -1,3 +1,4 @@
+import html
 import logging
 from datetime import datetime
 
@@ -6,10 +7,12 @@ from aiogram.filters import StateFilter, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State, default_state
 from aiogram.types import CallbackQuery, Message
-from gspread.exceptions import APIError
-
 import src.bot.keyboards.keyboards as kb
-from src.googlesheets.make_record import add_record
+from src.bot.delivery import delivery
+from src.bot.order_import import MAX_FILE_SIZE, parse_order_datetime, read_rows, split_message, validate_rows
+from src.bot.write_queue import submit_record
+from src.googlesheets.async_sheets import add_records
+from src.googlesheets.quota import limiter
 from ..db.db import add_tour_to_db, is_tour_title_exists, get_tours_by_type, get_tour_by_id, update_tour, \
     update_tour_title, get_all_tours, delete_tour_from_db
 from ..filters.filters import IsAdmin
@@ -42,6 +45,11 @@ class OrderInputState(StatesGroup):
     place = State()
 
 
+# State for Orders Import
+class ImportState(StatesGroup):
+    document = State()
+
+
 # State for Adding Tour
 class AddTourState(StatesGroup):
     title = State()
@@ -73,15 +81,16 @@ async def save_record(message: Message, state: FSMContext):
     ]
 
     try:
-        add_record(new_record)
-        await message.answer('✅ Запись успешно добавлена в Google Doc!')
-    except APIError as e:
-        await message.answer(f'⚠ Ошибка API Google Sheets. Попробуйте позже.')
-        logger.error(f'⚠ Google Sheets API error: {e}. Please try again later.')
-    except TypeError:
+        # Written to Google Sheets in the background; the admin is told when it's done
+        await submit_record(message.from_user.id, new_record)
+        await message.answer('📝 Запись принята и будет добавлена в Google Doc.')
+    except (TypeError, ValueError, IndexError):
         await message.answer('❌ Ошибка формата данных. Проверьте ввод.')
     except Exception as e:
-        logger.error(f'⚠ Unknown error while writing to Google Sheet: {e}')
+        # E.g. the database is locked: the answers are kept, so the admin can save the record again
+        logger.error(f'⚠ Unknown error while queueing a record: {e}')
+        await message.answer('❌ Не удалось сохранить запись. Попробуйте ещё раз: отправьте /log.')
+        return
 
     await state.clear()
 
@@ -104,7 +113,8 @@ async def cmd_cancel(message: Message, state: FSMContext):
         OrderInputState.guides: 'Добавление экскурсии отменено.',
         OrderInputState.price: 'Добавление экскурсии отменено.',
         OrderInputState.guests: 'Добавление экскурсии отменено.',
-        AddTourState.title: 'Добавление экскурсии отменено.'
+        AddTourState.title: 'Добавление экскурсии отменено.',
+        ImportState.document: 'Импорт заказов отменён.'
     }
 
     if current_state in cancel_messages:
@@ -113,6 +123,25 @@ async def cmd_cancel(message: Message, state: FSMContext):
     await state.clear()
 
 
+# ==================== Google Sheets quota =====================
+@router.message(Command(commands='quota'), StateFilter(default_state))
+async def cmd_quota(message: Message):
+    """ Shows how the bot uses the Google Sheets quota and sends messages since the start. """
+    stats = limiter.stats()
+    messages = delivery.stats()
+    await message.answer(
+        f"📊 Квота Google Sheets: {stats['tokens']} из {stats['capacity']} запросов в минуту свободно\n"
+        f"Запросы пользователей: {stats.get('calls_interactive', 0)}\n"
+        f"Уведомления: {stats.get('calls_scheduled', 0)}\n"
+        f"Фоновые обновления: {stats.get('calls_background', 0)}\n"
+        f"Ожидали квоту: {stats.get('waits', 0)} раз, {stats.get('wait_seconds', 0):.0f} с\n"
+        f"Ответы 429: {stats.get('throttled', 0)}, повторы: {stats.get('retries', 0)}, "
+        f"ошибки: {stats.get('errors', 0)}\n\n"
+        f"📨 Рассылки Telegram: отправлено {messages.get('sent', 0)}, повторы: {messages.get('retries', 0)}, "
+        f"не доставлено: {messages.get('failed', 0)}"
+    )
+
+
 # ==================== 'Дополнительно' button =====================
 @router.message(F.text == buttons['extra'])
 async def make_extra_keyboard(message: Message):
@@ -253,34 +282,23 @@ async def ask_for_datetime(callback: CallbackQuery, state: FSMContext):
 @router.message(OrderInputState.dt)
 async def get_datetime(message: Message, state: FSMContext):
     """ Date & time validation."""
-    date_text = message.text.strip()
-    date_formats = ["%d.%m.%Y %H:%M", "%d.%m.%y %H:%M"]
-    for fmt in date_formats:
-        try:
-            new_datetime = datetime.strptime(date_text, fmt)
-
-            # if year is like '26'
-            if new_datetime.year < 2000:
-                new_datetime = new_datetime.replace(year=new_datetime.year + 2000)
-
-            if new_datetime < datetime.now():
-                await message.answer("❌ Укажите корректную дату: она не может быть прошедшей.")
-                return
-
-            await state.update_data(new_datetime=new_datetime)
-            await message.answer(text=googledocs_text['tour_type'],
-                                 reply_markup=None)
-            await state.set_state(OrderInputState.tour_type)
-            return
+    new_datetime = parse_order_datetime(message.text)
+    if new_datetime is None:
+        await message.answer(
+            "❌ Неверный формат. Введите дату и время в формате:\n"
+            "• ДД.ММ.ГГГГ ЧЧ:ММ\n"
+            "• ДД.ММ.ГГ ЧЧ:ММ"
+        )
+        return
 
-        except ValueError:
-            continue
+    if new_datetime < datetime.now():
+        await message.answer("❌ Укажите корректную дату: она не может быть прошедшей.")
+        return
 
-    await message.answer(
-        "❌ Неверный формат. Введите дату и время в формате:\n"
-        "• ДД.ММ.ГГГГ ЧЧ:ММ\n"
-        "• ДД.ММ.ГГ ЧЧ:ММ"
-    )
+    await state.update_data(new_datetime=new_datetime)
+    await message.answer(text=googledocs_text['tour_type'],
+                         reply_markup=None)
+    await state.set_state(OrderInputState.tour_type)
 
 
 @router.message(OrderInputState.tour_type)
@@ -337,6 +355,57 @@ async def write_to_googledoc(message: Message, state: FSMContext):
     await save_record(message, state)
 
 
+# ==================== Orders import =====================
+@router.message(Command(commands='import'), StateFilter(default_state))
+async def cmd_import(message: Message, state: FSMContext):
+    """ Asks for a CSV/XLSX file with orders. """
+    await message.answer(googledocs_text['import'])
+    await state.set_state(ImportState.document)
+
+
+@router.message(ImportState.document, F.document)
+async def import_orders(message: Message, state: FSMContext):
+    """ Checks every row of the file and adds the valid orders to Google Sheets with one request. """
+    document = message.document
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        await message.answer('❌ Файл слишком большой. Пришлите файл до 1 МБ.')
+        return
+
+    try:
+        content = await message.bot.download(document)
+        rows = read_rows(document.file_name, content.read())
+    except ValueError as e:
+        # E.g. a decoding error, which may quote the file
+        await message.answer(f'❌ {html.escape(str(e))}')
+        return
+    except Exception as e:
+        logger.error(f'Error while reading import file {document.file_name}: {e}')
+        await message.answer('❌ Не удалось прочитать файл. Проверьте его и пришлите ещё раз.')
+        return
+
+    await state.clear()
+    records, report = validate_rows(rows)
+
+    if not records:
+        summary = '❌ В файле нет заказов, которые можно добавить.'
+    else:
+        try:
+            await add_records([(record_data, False) for record_data in records])
+            summary = f'✅ Добавлено заказов: {len(records)} из {len(report)}.'
+            logger.info(f'{message.from_user.id} imported {len(records)} orders from {document.file_name}')
+        except Exception as e:
+            logger.error(f'Error while importing orders from {document.file_name}: {e}')
+            summary = '⚠ Google Sheets недоступна, заказы не добавлены. Попробуйте позже.'
+
+    for text in split_message(report + [summary]):
+        await message.answer(text)
+
+
+@router.message(ImportState.document)
+async def import_wrong_input(message: Message):
+    await message.answer('Пришлите файл CSV или XLSX с заказами или нажмите /cancel.')
+
+
 # ==================== Adding excursion =====================
 @router.callback_query(F.data == 'add_on_request')
 async def add_individual_tour(
@@ -10,10 +10,12 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import CallbackQuery, Message
 
 import src.bot.keyboards.keyboards as kb
+from src.bot.delivery import delivery
 from src.bot.filters.filters import is_admin, is_guide, is_superadmin
 from src.bot.keyboards.calendar import generate_calendar
-from src.bot.texts.staff_texts import buttons, tour_texts
-from src.googlesheets.tours_filtering import filter_by_period, filter_for_sa_period
+from src.bot.texts.staff_texts import buttons, replies, tour_texts
+from src.googlesheets.async_sheets import find_tours
+from src.googlesheets.tours_filtering import TourQuery
 
 router = Router()
 
@@ -27,26 +29,38 @@ class DatesInputState(StatesGroup):
 
 
 async def send_tours_list(tours: list[dict], errors: list[str], message: Message,
-                          start_date: Optional[str] = None, end_date: Optional[str] = None):
-    """ Вывод сообщений с найденными экскурсиями или сообщения, что экскурсий нет."""
+                          start_date: Optional[str] = None, end_date: Optional[str] = None,
+                          data_time: Optional[datetime] = None):
+    """
+    Вывод сообщений с найденными экскурсиями или сообщения, что экскурсий нет.
+    data_time - время данных, если таблицы не удалось обновить.
+    """
+    # Таблицы не обновились: предупреждаем, что данные могут быть устаревшими
+    if data_time:
+        await message.answer(replies['stale_data'].format(time=data_time))
+
     if not tours and not errors:
         await message.answer(f"Нет экскурсий с {start_date} по {end_date} 🥺")
         return
 
+    # Длинный список отправляется с учётом лимитов Telegram
+    chat_id = message.chat.id
     if tours:
         for row in tours:
             tour_info = "\n".join(f"<b>{header}</b>: {info}" for header, info in row.items())
-            await message.answer(tour_info)
+            await delivery.send(message.bot, chat_id, tour_info)
 
         if start_date and end_date:
-            await message.answer(f"С {start_date} по {end_date} найдено экскурсий: {len(tours) + len(errors)}.")
+            await delivery.send(message.bot, chat_id,
+                                f"С {start_date} по {end_date} найдено экскурсий: {len(tours) + len(errors)}.")
         else:
-            await message.answer(f'Всего экскурсий: {len(tours) + len(errors)}')
+            await delivery.send(message.bot, chat_id, f'Всего экскурсий: {len(tours) + len(errors)}')
 
     # Отправка предупреждения, если есть ошибки
     if errors:
         errors_list = '\n'.join(errors)
-        await message.answer(
+        await delivery.send(
+            message.bot, chat_id,
             f"⚠️ Найдены ошибки в записи для экскурсий:\n"
             f"{errors_list}.\n<b>Сообщите, пожалуйста, администратору</b>."
         )
@@ -181,20 +195,21 @@ async def handle_tours_by_period(callback: CallbackQuery, state: FSMContext):
 
     try:
         if is_superadmin(user_id):
-            tours, errors = filter_for_sa_period(start_date, end_date)
+            query = TourQuery.for_period(start_date, end_date, superadmin=True)
         elif is_admin(user_id):
-            tours, errors = filter_by_period(start_date, end_date)
+            query = TourQuery.for_period(start_date, end_date)
         elif is_guide(user_id):
-            tours, errors = filter_by_period(start_date, end_date, guide=user_id)
+            query = TourQuery.for_period(start_date, end_date, guide=user_id)
         else:
             await callback.answer("У вас нет прав для выполнения этой команды.")
             return
+        tours, errors, data_time = await find_tours(query)
     except Exception as e:
         logger.error(f"Ошибка при загрузке экскурсий за период для {user_id}: {e}")
         await callback.message.answer("Произошла ошибка при обработке вашего запроса. Сообщите администратору.")
         return
 
-    await send_tours_list(tours, errors, callback.message, first_date, second_date)
+    await send_tours_list(tours, errors, callback.message, first_date, second_date, data_time)
 
     # Сброс состояния
     await state.clear()
@@ -211,19 +226,20 @@ async def handle_all_tours(callback: CallbackQuery):
 
     try:
         if is_superadmin(user_id):
-            tours, errors = filter_for_sa_period()
+            query = TourQuery.for_period(superadmin=True)
         # Поиск экскурсий из гугл докса для админа
         elif is_admin(user_id):
-            tours, errors = filter_by_period()
+            query = TourQuery.for_period()
         # Поиск экскурсий из гугл докса для гидов
         elif is_guide(user_id):
-            tours, errors = filter_by_period(guide=user_id)
+            query = TourQuery.for_period(guide=user_id)
         else:
             await callback.answer("У вас нет прав для выполнения этой команды.")
             return
+        tours, errors, data_time = await find_tours(query)
     except Exception as e:
         logger.error(f"Ошибка при фильтрации экскурсий у {user_id}: {e}")
         await callback.message.answer("Произошла ошибка при обработке вашего запроса. Сообщите администратору.")
         return
 
-    await send_tours_list(tours, errors, callback.message)
+    await send_tours_list(tours, errors, callback.message, data_time=data_time)
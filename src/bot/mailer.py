@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import time
+from email.message import Message
+
+import aiosmtplib
+
+from ..config import config
+
+logger = logging.getLogger(__name__)
+
+# SMTP connections open at the same time. Each one logs in once and sends its messages one after another.
+POOL_SIZE = 3
+
+# A message is sent again over a new connection if the server dropped the old one
+MAX_ATTEMPTS = 2
+
+
+def smtp_client() -> aiosmtplib.SMTP:
+    return aiosmtplib.SMTP(
+        hostname=config.hostname,
+        port=config.port,
+        username=config.email_username,
+        password=config.email_password,
+        use_tls=config.use_tls
+    )
+
+
+async def _send_from_queue(queue: asyncio.Queue, failed: list[str]) -> None:
+    """ Sends messages from the queue over one connection, reconnecting if it is lost. """
+    smtp = smtp_client()
+    try:
+        while not queue.empty():
+            message = queue.get_nowait()
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    if not smtp.is_connected:
+                        await smtp.connect()
+                    await smtp.send_message(message)
+                    break
+                except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError) as e:
+                    smtp.close()
+                    if attempt == MAX_ATTEMPTS - 1:
+                        logger.error(f'Error while sending email to {message["To"]}: {e}')
+                        failed.append(message['To'])
+                except (aiosmtplib.SMTPException, ValueError) as e:
+                    # Rejected by the server or a message without a valid address
+                    logger.error(f'Error while sending email to {message["To"]}: {e}')
+                    failed.append(message['To'])
+                    break
+    finally:
+        if smtp.is_connected:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+
+
+async def send_emails(messages: list[Message]) -> dict:
+    """
+    Sends the messages over a small pool of SMTP connections, so the time grows with the number
+    of messages, not with connecting and logging in for each of them.
+    Returns the number of sent messages, the addresses that didn't get theirs and the time taken.
+    """
+    start = time.monotonic()
+    queue = asyncio.Queue()
+    for message in messages:
+        queue.put_nowait(message)
+
+    failed = []
+    await asyncio.gather(*(_send_from_queue(queue, failed) for _ in range(min(POOL_SIZE, len(messages)))))
+
+    seconds = time.monotonic() - start
+    sent = len(messages) - len(failed)
+    logger.info(f'Sent {sent} of {len(messages)} emails in {seconds:.1f} s, failed: {failed or "none"}')
+    return {'sent': sent, 'failed': failed, 'seconds': seconds}
@@ -0,0 +1,146 @@
+import csv
+import html
+import io
+from datetime import date, datetime, time
+from typing import Optional
+
+from openpyxl import load_workbook
+
+from src.googlesheets.make_record import parse_record
+
+# Columns of an import file, in this order. A header row is skipped.
+IMPORT_COLUMNS = ('Дата', 'Время', 'Программа', 'Заказчик, контакты', 'Гиды', 'Стоимость', 'Гости', 'Место')
+
+MAX_ROWS = 200
+MAX_FILE_SIZE = 1024 * 1024
+
+# Telegram limit is 4096 characters
+MESSAGE_LIMIT = 4000
+
+DATETIME_FORMATS = ("%d.%m.%Y %H:%M", "%d.%m.%y %H:%M")
+
+
+def parse_order_datetime(text: str) -> Optional[datetime]:
+    """ Date and time of a new order: 'дд.мм.гггг чч:мм' or 'дд.мм.гг чч:мм'. None if the format is wrong. """
+    for fmt in DATETIME_FORMATS:
+        try:
+            new_datetime = datetime.strptime(text.strip(), fmt)
+        except ValueError:
+            continue
+
+        # if year is like '26'
+        if new_datetime.year < 2000:
+            new_datetime = new_datetime.replace(year=new_datetime.year + 2000)
+        return new_datetime
+    return None
+
+
+# =================== Reading files ===================
+def cell_text(value) -> str:
+    """ Cell of a spreadsheet as the admin would type it. """
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%d.%m.%Y') if value.time() == time() else value.strftime('%d.%m.%Y %H:%M')
+    if isinstance(value, date):
+        return value.strftime('%d.%m.%Y')
+    if isinstance(value, time):
+        return value.strftime('%H:%M')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def read_csv(content: bytes) -> list[list[str]]:
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        # Excel saves CSV in the system code page
+        text = content.decode('cp1251')
+
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=';,\t')
+    except csv.Error:
+        dialect = csv.excel
+    return [[cell.strip() for cell in row] for row in csv.reader(io.StringIO(text), dialect)]
+
+
+def read_xlsx(content: bytes) -> list[list[str]]:
+    workbook = load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    try:
+        return [[cell_text(value) for value in row] for row in workbook.active.iter_rows(values_only=True)]
+    finally:
+        workbook.close()
+
+
+def read_rows(file_name: str, content: bytes) -> list[tuple[int, list[str]]]:
+    """ Non-empty rows of the file with their numbers. Raises ValueError if the file can't be read. """
+    extension = file_name.lower().rsplit('.', 1)[-1] if file_name else ''
+    if extension == 'csv':
+        rows = read_csv(content)
+    elif extension == 'xlsx':
+        rows = read_xlsx(content)
+    else:
+        raise ValueError('Поддерживаются файлы CSV и XLSX.')
+
+    numbered = [(number, row) for number, row in enumerate(rows, start=1) if any(row)]
+    # Header: the first cell is not a date
+    if numbered and not numbered[0][1][0][:1].isdigit():
+        numbered = numbered[1:]
+
+    if len(numbered) > MAX_ROWS:
+        raise ValueError(f'В файле {len(numbered)} строк, за раз можно добавить не больше {MAX_ROWS}.')
+    return numbered
+
+
+# =================== Validation ===================
+def make_import_record(row: list[str]) -> list:
+    """ Record data as collected by the order dialog. Raises ValueError with the reason. """
+    tour_date, tour_time, tour_type, client_data, guides, price, guests, place = (row + [''] * 8)[:8]
+
+    new_datetime = parse_order_datetime(f'{tour_date} {tour_time}')
+    if new_datetime is None:
+        raise ValueError('неверный формат даты или времени')
+    if new_datetime < datetime.now():
+        raise ValueError('дата не может быть прошедшей')
+    if not tour_type:
+        raise ValueError('не указана программа')
+    if tour_type.isdigit() and not 1 <= int(tour_type) <= 7:
+        raise ValueError('неверный номер программы')
+
+    record_data = [new_datetime.strftime('%d.%m.%Y'), new_datetime.strftime('%H:%M'),
+                   tour_type, client_data, guides, price, guests, place]
+    try:
+        parse_record(record_data)
+    except (TypeError, ValueError, IndexError):
+        raise ValueError('ошибка формата данных')
+    return record_data
+
+
+def validate_rows(rows: list[tuple[int, list[str]]]) -> tuple[list[list], list[str]]:
+    """ Records that can be added and a report line for each row of the file. """
+    records, report = [], []
+    for number, row in rows:
+        try:
+            record_data = make_import_record(row)
+        except ValueError as e:
+            report.append(f'❌ Строка {number}: {e}')
+            continue
+        records.append(record_data)
+        # The program is text from the file, and the bot sends HTML
+        report.append(f'✅ Строка {number}: {record_data[0]} {record_data[1]}, '
+                      f'{html.escape(parse_record(record_data)[2])}')
+    return records, report
+
+
+def split_message(lines: list[str]) -> list[str]:
+    """ Joins lines into messages that fit into Telegram's limit. """
+    messages, current = [], ''
+    for line in lines:
+        if current and len(current) + len(line) + 1 > MESSAGE_LIMIT:
+            messages.append(current)
+            current = ''
+        current = f'{current}\n{line}' if current else line
+    if current:
+        messages.append(current)
+    return messages
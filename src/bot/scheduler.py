@@ -3,40 +3,62 @@ from datetime import date, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-import aiosmtplib
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from ..bot.db import get_users
-from ..bot.db.db import get_user_email
+from ..bot.db.db import get_user_emails
+from ..bot.delivery import delivery
 from ..bot.filters import is_superadmin, is_admin, is_guide
 from ..bot.keyboards import check_btn
+from ..bot.mailer import send_emails
 from ..config import config
-from ..googlesheets.tours_filtering import filter_for_sa_date, filter_by_date, GUIDES
+from ..googlesheets.async_sheets import run_sync
+from ..googlesheets.guides import GUIDES
+from ..googlesheets.mirror import get_snapshot
+from ..googlesheets.quota import Priority, priority
+from ..googlesheets.snapshot import sheets_cache
+from ..googlesheets.tours_filtering import TourQuery, find_tours
 
 logger = logging.getLogger()
 
 
-def build_notification(user_id: int | str) -> tuple[str, list[dict], list[str]] | None:
-    """Returns (day, tours, errors) or None if user has no role or no tours."""
+def notification_query(user_id: int | str) -> tuple[TourQuery, str] | None:
+    """ Query for the user's notification and the day it is about. None if the user has no role. """
     admins_notif = date.today() + timedelta(days=2)
     guides_notif = date.today() + timedelta(days=1)
 
     if is_superadmin(user_id):
-        tours, errors = filter_for_sa_date(guides_notif)
-        day = 'завтра'
-    elif is_admin(user_id):
-        tours, errors = filter_by_date(admins_notif)
-        day = 'послезавтра'
-    elif is_guide(user_id):
-        tours, errors = filter_by_date(guides_notif, guide=user_id)
-        day = 'завтра'
-    else:
-        return None
-
-    if not tours and not errors:
-        return None
-
-    return day, tours, errors
+        return TourQuery.for_date(guides_notif, superadmin=True), 'завтра'
+    if is_admin(user_id):
+        return TourQuery.for_date(admins_notif), 'послезавтра'
+    if is_guide(user_id):
+        return TourQuery.for_date(guides_notif, guide=user_id), 'завтра'
+    return None
+
+
+def build_notifications(user_ids: list[int]) -> list[tuple[list[int], str, list[dict], list[str]]]:
+    """
+    Returns (users, day, tours, errors) for each group of users getting the same notification.
+    All of them are built from one snapshot, and each distinct query runs once:
+    e.g. all admins share one query. Users without a role or without tours are skipped.
+    """
+    groups: dict[TourQuery, list[int]] = {}
+    days: dict[TourQuery, str] = {}
+    for user_id in user_ids:
+        if not (result := notification_query(user_id)):
+            continue
+        query, days[query] = result
+        groups.setdefault(query, []).append(user_id)
+
+    notifications = []
+    # Users pressing buttons are served first
+    with priority(Priority.SCHEDULED):
+        snapshot = get_snapshot()
+        for query, users in groups.items():
+            tours, errors = find_tours(query, snapshot)
+            if tours or errors:
+                notifications.append((users, days[query], tours, errors))
+    return notifications
 
 
 def build_message(day: str, tours: list[dict], errors: list[str], extended: bool = False) -> str:
@@ -60,22 +82,23 @@ def build_message(day: str, tours: list[dict], errors: list[str], extended: bool
 async def notify_telegram(bot):
     debug_data = {}
 
-    for user_id in get_users():
-        try:
-            result = build_notification(user_id)
-            if not result:
-                continue
+    try:
+        notifications = await run_sync(build_notifications, get_users())
+    except Exception as e:
+        logger.error(f'Error while building notifications: {e}')
+        return
 
-            day, tours, errors = result
-            text = build_message(day, tours, errors)
+    messages = []
+    for user_ids, day, tours, errors in notifications:
+        # Users with the same tours share the message
+        text = build_message(day, tours, errors)
 
+        for user_id in user_ids:
             if tours:
                 debug_data[user_id] = len(tours)
+            messages.append((user_id, text))
 
-            await bot.send_message(chat_id=user_id, text=text, reply_markup=check_btn, parse_mode='HTML')
-
-        except Exception as e:
-            logger.error(f'Error while sending notification to user {user_id}: {e}')
+    await delivery.fan_out(bot, messages, reply_markup=check_btn, parse_mode='HTML')
 
     summary = '; '.join(f'{uid}: {t} tours' for uid, t in debug_data.items())
     logger.info(f'Bot notifications summary: {summary}')
@@ -85,15 +108,22 @@ async def notify_email():
     """Sends email notifications."""
     debug_data = {}
 
-    for user_id in get_users():
-        try:
-            result = build_notification(user_id)
-            if not result:
-                continue
+    try:
+        notifications = await run_sync(build_notifications, get_users())
+    except Exception as e:
+        logger.error(f'Error while building email notifications: {e}')
+        return
 
-            day, tours, errors = result
-            text = build_message(day, tours, errors, extended=True)
-            email = await get_user_email(user_id)
+    # One query for the emails of all recipients
+    emails = await get_user_emails([user_id for user_ids, *_ in notifications for user_id in user_ids])
+
+    messages = []
+    for user_ids, day, tours, errors in notifications:
+        # Users with the same tours share the message
+        text = build_message(day, tours, errors, extended=True)
+
+        for user_id in user_ids:
+            email = emails.get(user_id)
 
             if not email:
                 continue
@@ -107,18 +137,9 @@ async def notify_email():
 
             if tours:
                 debug_data[user_id] = len(tours)
+            messages.append(message)
 
-            await aiosmtplib.send(
-                message,
-                hostname=config.hostname,
-                port=config.port,
-                username=config.email_username,
-                password=config.email_password,
-                use_tls=config.use_tls
-            )
-
-        except Exception as e:
-            logger.error(f'Error while sending email to {user_id}: {e}')
+    await send_emails(messages)
 
     guides = []
     for uid in debug_data.keys():
@@ -138,4 +159,7 @@ def setup_scheduler(bot):
     scheduler = AsyncIOScheduler(timezone='Europe/Moscow')
     scheduler.add_job(notify_telegram, 'cron', hour=11, minute=0, args=[bot])
     scheduler.add_job(notify_email, 'cron', hour=19, minute=0)
+
+    # Keep the sheets snapshot fresh in the background, so queries rarely wait for a download
+    scheduler.add_job(sheets_cache.background_refresh, 'interval', seconds=sheets_cache.ttl)
     scheduler.start()
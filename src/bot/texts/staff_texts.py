@@ -1,6 +1,7 @@
 replies = {
     'greeting': 'Здравы будьте!',
-    'no_excursions': 'К сожалению, нет запланированных экскурсий 😢'
+    'no_excursions': 'К сожалению, нет запланированных экскурсий 😢',
+    'stale_data': '⚠️ Google таблица сейчас недоступна, показаны данные на {time:%d.%m %H:%M}.'
 }
 
 buttons = {
@@ -52,7 +53,11 @@ googledocs_text = {
     'guests': 'Введите количество и категорию гостей через запятую.\n\n'
               'Или нажмите /log для создания записи.',
     'place': 'Напишите место старта и завершения программы через запятую.\n\n'
-             'Или нажмите /log для создания записи.'
+             'Или нажмите /log для создания записи.',
+    'import': 'Пришлите файл CSV или XLSX с заказами. Для отмены нажмите /cancel.\n\n'
+              'Столбцы по порядку: <b>дата</b> (дд.мм.гггг), <b>время</b> (чч:мм), <b>программа</b> '
+              '(номер 1-7 или название), заказчик и контакты, гиды, стоимость, гости, место. '
+              'Строка с заголовками пропускается.'
 
 
 }
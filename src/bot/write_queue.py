@@ -0,0 +1,175 @@
+import asyncio
+import html
+import logging
+
+from aiogram import Bot
+from gspread.exceptions import APIError
+from requests.exceptions import ChunkedEncodingError, ConnectTimeout, ReadTimeout
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from urllib3.exceptions import MaxRetryError
+
+from src.bot.db.db import add_pending_record, get_pending_records, mark_records_attempted, \
+    mark_records_committed, mark_records_failed, mark_records_writing
+from src.googlesheets.async_sheets import add_records
+from src.googlesheets.make_record import parse_record, record_datetime
+from src.googlesheets.quota import response_status
+
+logger = logging.getLogger(__name__)
+
+# Records written with one batch update
+BATCH_SIZE = 50
+
+# Delay after a failed write, doubled after each failure
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 600
+
+# Set when a record is queued
+_new_records = asyncio.Event()
+
+
+def describe(record_data: list) -> str:
+    """ Short description of the record for messages. The program is typed by the admin: escaped for HTML. """
+    return f'{record_data[0]} {record_data[1]}, {html.escape(str(record_data[2]))}'
+
+
+def is_permanent(error: Exception) -> bool:
+    """ The records can never be written as they are: repeating won't help. """
+    if isinstance(error, APIError):
+        return response_status(error) == 400
+    return isinstance(error, (TypeError, ValueError, IndexError))
+
+
+def is_uncertain(error: Exception) -> bool:
+    """
+    Google may have applied the write: the request was sent, but its response was lost,
+    e.g. on a read timeout or a connection dropped while waiting.
+    Not if the connection could not be opened, nor after an error response: then nothing was written.
+    """
+    if isinstance(error, (ReadTimeout, ChunkedEncodingError)):
+        return True
+    # A connection that was never opened comes wrapped in MaxRetryError
+    return (isinstance(error, RequestsConnectionError) and not isinstance(error, ConnectTimeout)
+            and not (error.args and isinstance(error.args[0], MaxRetryError)))
+
+
+async def submit_record(user_id: int, record_data: list, highlight: bool = False) -> int:
+    """
+    Queues a record for writing to Google Sheets and returns at once.
+    Raises TypeError or ValueError if the record data is invalid.
+    """
+    record_datetime(record_data)
+    parse_record(record_data)
+
+    record_id = await add_pending_record(user_id, record_data, highlight)
+    _new_records.set()
+    logger.info(f'Record {record_id} from {user_id} queued: {describe(record_data)}')
+    return record_id
+
+
+async def notify(bot: Bot, user_id: int, text: str) -> None:
+    try:
+        await bot.send_message(chat_id=user_id, text=text)
+    except Exception as e:
+        logger.error(f'Error while notifying {user_id} about a record: {e}')
+
+
+async def write_worker(bot: Bot) -> None:
+    """
+    Writes queued records to Google Sheets in batches and tells the admins when their record is added.
+    Records stay in the queue until they are written, so they survive outages and restarts.
+    """
+    failures = 0
+    # Records of a rejected batch still to be written one by one
+    isolating = 0
+
+    while True:
+        try:
+            # Cleared before reading the queue, so a record queued meanwhile is not missed
+            _new_records.clear()
+            pending = await get_pending_records(1 if isolating else BATCH_SIZE)
+            if not pending:
+                # Queue is empty: wait for new records
+                isolating = 0
+                await _new_records.wait()
+                continue
+
+            written, rejected = await write_batch(bot, pending)
+            if rejected:
+                isolating = rejected
+            elif written and isolating:
+                isolating -= 1
+        except Exception as e:
+            # E.g. the database is locked: the records stay in the queue
+            written = False
+            logger.error(f'Write queue error: {e}')
+
+        if written:
+            failures = 0
+            continue
+
+        failures += 1
+        delay = min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+        logger.info(f'Writing queued records again in {delay} s')
+        await asyncio.sleep(delay)
+
+
+async def write_batch(bot: Bot, pending: list[tuple[int, int, list, bool, int, bool]]) -> tuple[bool, int]:
+    """
+    Writes a batch of queued records. Returns whether the queue can go on without a pause
+    and, if Google rejected the whole batch, its size: those records are then written one by one.
+    """
+    record_ids = [record_id for record_id, *_ in pending]
+    # Until the write is confirmed: after a crash or a lost response the records are looked for in the sheet
+    await mark_records_writing(record_ids)
+    try:
+        await add_records([(record_data, highlight) for _, _, record_data, highlight, _, _ in pending],
+                          uncertain=[uncertain for *_, uncertain in pending])
+    except Exception as e:
+        if is_permanent(e) and len(pending) > 1:
+            # Find the broken record: write the queue one by one
+            logger.error(f'Batch of {len(pending)} records rejected, writing them one by one: {e}')
+            await mark_records_attempted(record_ids, str(e))
+            return True, len(pending)
+
+        if is_permanent(e):
+            logger.error(f'Record {record_ids[0]} can not be written: {e}')
+            await mark_records_failed(record_ids, str(e))
+            _, user_id, record_data, *_ = pending[0]
+            await notify(bot, user_id, f'❌ Не удалось добавить запись {describe(record_data)} в Google Doc. '
+                                       f'Проверьте данные и добавьте её вручную.')
+            return True, 0
+
+        logger.error(f'Writing {len(pending)} records failed: {e}')
+        await mark_records_attempted(record_ids, str(e), uncertain=is_uncertain(e))
+
+        # Tell once, after the first failed attempt, that the record is not lost
+        for _, user_id, record_data, _, attempts, _ in pending:
+            if attempts == 0:
+                await notify(bot, user_id, f'⏳ Google Sheets сейчас недоступна. Запись {describe(record_data)} '
+                                           f'сохранена и будет добавлена автоматически.')
+        return False, 0
+
+    await mark_records_committed(record_ids)
+    logger.info(f'{len(pending)} records written to Google Sheets')
+    for _, user_id, record_data, *_ in pending:
+        await notify(bot, user_id, f'✅ Запись {describe(record_data)} добавлена в Google Doc!')
+    return True, 0
+
+
+# The running worker: kept here, so the task is not garbage collected
+_worker_task: asyncio.Task | None = None
+
+
+def start_write_worker(bot: Bot) -> asyncio.Task:
+    """ Starts the write worker. If it ever stops with an error, it is logged and the worker is started again. """
+    global _worker_task
+    _worker_task = asyncio.create_task(write_worker(bot))
+    _worker_task.add_done_callback(lambda task: _restart_worker(task, bot))
+    return _worker_task
+
+
+def _restart_worker(task: asyncio.Task, bot: Bot) -> None:
+    if task.cancelled():
+        return
+    logger.error(f'Write worker stopped, restarting in {RETRY_DELAY} s', exc_info=task.exception())
+    asyncio.get_running_loop().call_later(RETRY_DELAY, start_write_worker, bot)
@@ -11,6 +11,12 @@ class Config(SimpleNamespace):
     guide_ids: list[int]
     db_path: str
     credential_file: str
+    orders_cache_ttl: int
+    sheets_workers: int
+    sheets_timeout: float
+    snapshot_path: str
+    sheets_quota: int
+    guides_file: str
 
 
 def load_config(path: str | None = None) -> Config:
@@ -25,6 +31,12 @@ def load_config(path: str | None = None) -> Config:
         guide_ids=env.list('GUIDE_IDS', subcast=int),
         db_path=env('BOT_DB_PATH', default='data/slavna.db'),
         credential_file=env('GOOGLE_CREDS'),
+        orders_cache_ttl=env.int('ORDERS_CACHE_TTL', default=300),
+        sheets_workers=env.int('SHEETS_WORKERS', default=4),
+        sheets_timeout=env.float('SHEETS_TIMEOUT', default=30),
+        snapshot_path=env('SNAPSHOT_PATH', default='data/orders.snapshot'),
+        sheets_quota=env.int('SHEETS_QUOTA', default=60),
+        guides_file=env('GUIDES_FILE', default='data/guides.json'),
 
         # email
         hostname=env('EMAIL_HOST'),
@@ -0,0 +1,82 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Optional, Sequence, TypeVar
+
+from src.config import config
+from src.googlesheets import make_record, tours_filtering
+from src.googlesheets.mirror import get_snapshot
+from src.googlesheets.snapshot import load_snapshot, sheets_cache
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# gspread is synchronous: all its calls run here, off the event loop.
+# The pool is bounded so a burst of requests can't spawn unlimited threads.
+executor = ThreadPoolExecutor(max_workers=config.sheets_workers, thread_name_prefix='gsheets')
+
+
+async def run_sync(func: Callable[..., T], *args, timeout: Optional[float] = config.sheets_timeout, **kwargs) -> T:
+    """
+    Runs blocking Google Sheets code in the thread pool and waits for the result.
+
+    Raises TimeoutError if the call takes longer than the timeout (None - no limit). A call cancelled before
+    it has started is removed from the pool queue; a running one finishes in the background
+    and its result is discarded.
+    """
+    loop = asyncio.get_running_loop()
+    # The context is copied, as in asyncio.to_thread, so the call keeps its quota priority
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    future = loop.run_in_executor(executor, call)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except TimeoutError:
+        logger.error(f'Google Sheets call {func.__name__} timed out')
+        raise
+
+
+# =================== Startup ===================
+async def warm_up() -> None:
+    """
+    Serves the snapshot saved before the restart at once, if there is one, and downloads
+    fresh sheets concurrently in the background. A handler that needs data before anything
+    is loaded waits on the snapshot being loaded instead of starting its own download.
+    """
+    saved = await run_sync(load_snapshot)
+    if saved:
+        sheets_cache.restore(saved)
+        logger.info(f'Таблицы восстановлены с диска, данные на {saved.data_time:%d.%m.%Y %H:%M}')
+
+    try:
+        # The saved data is replaced right away in the background; without it, readers share this first download
+        snapshot = await run_sync(sheets_cache.background_refresh if saved else sheets_cache.get)
+    except Exception as e:
+        logger.error(f'Не удалось загрузить Google таблицы при запуске: {e}')
+        return
+
+    for name, data in snapshot.sources.items():
+        logger.info(f"Таблица '{name}' загружена: {len(data.rows)} строк")
+
+
+# =================== Sheets data ===================
+async def add_records(records: list[tuple[list, bool]], uncertain: Sequence[bool] = ()) -> None:
+    # No timeout: a write that finished after it would be repeated.
+    # Each request is still limited by the client timeout.
+    await run_sync(make_record.add_records, records, uncertain, timeout=None)
+
+
+# =================== Tours filtering ===================
+def _find_tours_with_time(query: tours_filtering.TourQuery) -> tuple[list[dict], list[str], Optional[datetime]]:
+    """ Tours and errors of the query, and the time of the data if the sheets couldn't be refreshed. """
+    snapshot = get_snapshot()
+    tours, errors = tours_filtering.find_tours(query, snapshot)
+    # Of the same snapshot as the tours
+    return tours, errors, snapshot.data_time if snapshot.stale else None
+
+
+async def find_tours(query: tours_filtering.TourQuery) -> tuple[list[dict], list[str], Optional[datetime]]:
+    return await run_sync(_find_tours_with_time, query)
@@ -0,0 +1,41 @@
+import threading
+from collections import defaultdict
+
+import gspread
+
+from src.config import config
+from src.googlesheets.quota import limiter
+
+_client: gspread.Client | None = None
+_client_lock = threading.Lock()
+
+_worksheets: dict[tuple[str, str], gspread.Worksheet] = {}
+_worksheet_locks: defaultdict[tuple[str, str], threading.Lock] = defaultdict(threading.Lock)
+
+
+def get_client() -> gspread.Client:
+    """ Authenticates with the service account on first use. """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = gspread.service_account(filename=config.credential_file)
+            _client.set_timeout(config.sheets_timeout)
+        return _client
+
+
+def open_worksheet(url: str, name: str) -> gspread.Worksheet:
+    """
+    Opens a worksheet by spreadsheet url and sheet name on first use.
+    Different worksheets can be opened concurrently; the same one is opened only once.
+    """
+    key = (url, name)
+    if key in _worksheets:
+        return _worksheets[key]
+
+    with _client_lock:
+        lock = _worksheet_locks[key]
+    with lock:
+        if key not in _worksheets:
+            spreadsheet = limiter.call(get_client().open_by_url, url)
+            _worksheets[key] = limiter.call(spreadsheet.worksheet, name)
+        return _worksheets[key]
@@ -1,51 +1,59 @@
 import logging
+from typing import Optional
 
 import gspread
 from environs import Env
 
 from src.config import config
+from src.googlesheets.client import open_worksheet
+from src.googlesheets.index import DateIndex
+from src.googlesheets.projection import View
+from src.googlesheets.quota import limiter
+from src.googlesheets.snapshot import Snapshot, register_source, sheets_cache
 
 env = Env()
 env.read_env('.env')
 
 logger = logging.getLogger(__name__)
 
-gc = gspread.service_account(filename=config.credential_file)
-
-# Opening a Google Sheet via a link
+# Link to the Google Sheet with orders
 sheet_url = env('SPREADSHEET_URL')
-sh = gc.open_by_url(sheet_url)
+SHEET_NAME = 'Заказы'
+
 
-# Select sheet (by name or index)
-worksheet = sh.worksheet('Заказы')
+# Select sheet (by name or index). The sheet is opened on first use.
+def get_worksheet() -> gspread.Worksheet:
+    return open_worksheet(sheet_url, SHEET_NAME)
 
 
-# Returns data from a table as a list of dicts.
+# Downloads data from a table as a list of dicts.
 # Each dict is a row of the table with keys in column order.
-def get_orders() -> list[dict[str, int | float | str]]:
+def fetch_orders() -> list[dict[str, int | float | str]]:
     # Loading all data in one request
-    data = worksheet.get_all_records()
+    data = limiter.call(get_worksheet().get_all_records)
     if not data:
         logger.error('Гугл таблица пуста или недоступна.')
         raise ValueError("Таблица пуста или недоступна.")
     return data
 
 
-# Cache data after loading
-cached_data = get_orders()
+# The sheet is downloaded together with the other order sheets
+register_source(SHEET_NAME, fetch_orders)
 
 
-# Detailed information on orders (12 columns) for admins
-def get_extended_columns() -> list[str]:
-    return list(cached_data[0].keys())[:12]
+# Returns orders from the cached snapshot indexed by date.
+# If guide_id is passed, only the orders of this guide.
+def get_orders_index(guide_id: Optional[int] = None, snapshot: Optional[Snapshot] = None) -> DateIndex:
+    orders = (snapshot or sheets_cache.get())[SHEET_NAME]
+    return orders.guide_index.get(guide_id) if guide_id else orders.date_index
 
 
-# Reduced information on orders (6 columns) for all
-def get_brief_columns() -> list[str]:
-    return list(cached_data[0].keys())[:6]
+# =================== Views ===================
+# Detailed information on orders (12 columns) for admins
+EXTENDED_VIEW: View = ((SHEET_NAME, ((0, 12),)),)
 
+# Reduced information on orders (6 columns) for all
+BRIEF_VIEW: View = ((SHEET_NAME, ((0, 6),)),)
 
 # Detailed information on orders (10 columns) for guides
-def get_guides_columns() -> list[str]:
-    headers = list(cached_data[0])
-    return headers[:5] + headers[7:12]
+GUIDES_VIEW: View = ((SHEET_NAME, ((0, 5), (7, 12))),)
@@ -0,0 +1,61 @@
+import json
+import os
+
+from environs import Env
+
+from src.config import config
+from src.googlesheets.matcher import NameMatcher
+
+env = Env()
+env.read_env('.env')
+
+
+# =================== Registry ===================
+def guides_from_env() -> list[dict]:
+    """ The registry of the guides without GUIDES_FILE: their IDs and the links to the personal sheets are in env. """
+    return [
+        {'id': int(env('FEOFANIYA')), 'name': 'Маркова', 'stage_name': 'Феофания',
+         'sheet': {'name': 'Маркова', 'url': env('SPREADSHEET_M_URL'), 'columns': [[0, 3], [4, 7], [8, 9]]}},
+        {'id': int(env('ZABAVA')), 'name': 'Путятина', 'stage_name': 'Забава',
+         'sheet': {'name': 'Путятина', 'url': env('SPREADSHEET_P_URL'), 'columns': [[0, 3], [4, 7], [8, 10]]}},
+        {'id': int(env('AGAFYA')), 'name': 'Агафья', 'stage_name': 'Ясна'},
+        {'id': int(env('MIROSLAVA')), 'name': 'Вейкова', 'stage_name': 'Мирослава'},
+        {'id': int(env('ULYANA')), 'name': 'Ульяна', 'stage_name': ''},
+        {'id': int(env('STESHA')), 'name': 'Анжела', 'stage_name': 'Стеша'},
+        {'id': int(env('ANDREY')), 'name': 'Андрей', 'stage_name': 'Ондрейка'},
+        {'id': int(env('ZAVID')), 'name': 'Женя', 'stage_name': 'Мишка'},
+        {'id': int(env('OLGA')), 'name': 'Ольга', 'stage_name': 'Хавронья'},
+    ]
+
+
+def load_guides(path: str) -> list[dict]:
+    """
+    Guides from the JSON registry: a list of {"id", "name", "stage_name", "aliases", "sheet"}.
+    "sheet" is the guide's personal sheet, if there is one: {"name", "url", "columns", "brief_columns"},
+    where columns are [start, end) ranges of the sheet columns shown for a day and for a period.
+    Adding a guide or a personal sheet needs no code change.
+    """
+    if not os.path.exists(path):
+        return guides_from_env()
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Guide ID -> name, stage name, aliases and personal sheet
+GUIDES = {guide['id']: guide for guide in load_guides(config.guides_file)}
+
+# Guide ID -> personal sheet with their orders from other services
+PERSONAL_SHEETS = {guide_id: guide['sheet'] for guide_id, guide in GUIDES.items() if guide.get('sheet')}
+
+# Columns with the guides of a tour
+GUIDE_COLUMNS = ('Герой', 'Второй герой')
+
+
+# Recognises guides' names with typos. Matches are cached per word,
+# so unchanged cells cost nothing when a snapshot is rebuilt.
+matcher = NameMatcher(GUIDES)
+
+
+def record_guides(cells: dict) -> frozenset[int]:
+    """ Ids of the guides mentioned in the 'Герой' and 'Второй герой' fields of a row. """
+    return frozenset().union(*(matcher.find(str(cells.get(column, ''))) for column in GUIDE_COLUMNS))
@@ -0,0 +1,77 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from operator import attrgetter
+from datetime import date, datetime, time
+from typing import Optional
+
+from src.googlesheets.guides import record_guides
+from src.googlesheets.records import OrderRecord
+
+
+class DateIndex:
+    """
+    Sheet records sorted by date and start time, for range lookups with binary search.
+    Any range is already in the order of the tours, so it is never sorted again.
+    Records without a valid date are left out. Records starting at the same time keep their order in the sheet.
+    """
+
+    def __init__(self, records: list[OrderRecord]):
+        dated = sorted((record for record in records if record.date), key=attrgetter('sort_key'))
+
+        self._dates = [record.date for record in dated]
+        self._records = dated
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def between(self, start_date: date, end_date: Optional[date] = None) -> list[OrderRecord]:
+        """ Records from start_date to end_date inclusive. Without end_date - up to the end of the sheet. """
+        low = bisect_left(self._dates, start_date)
+        high = bisect_right(self._dates, end_date) if end_date else len(self._dates)
+        return self._records[low:high]
+
+
+class RowPositions:
+    """
+    Start of the rows in sheet order, for finding where a new row goes with binary search.
+    A row without time starts at 00:00; rows without a date or with an invalid time are skipped.
+    """
+
+    def __init__(self, records: list[OrderRecord]):
+        self._records = [record for record in records if self.has_start(record)]
+
+        # Running maximum: the search finds the first later row in sheet order even if the sheet isn't sorted
+        self._latest = []
+        latest = datetime.min
+        for record in self._records:
+            latest = max(latest, datetime.combine(record.date, record.start or time()))
+            self._latest.append(latest)
+
+    @staticmethod
+    def has_start(record: OrderRecord) -> bool:
+        return bool(record.date) and (record.start is not None or not record.cells.get('Время'))
+
+    def first_after(self, moment: datetime) -> Optional[OrderRecord]:
+        """ The first row starting later than the moment, None if there is no such row. """
+        position = bisect_right(self._latest, moment)
+        return self._records[position] if position < len(self._records) else None
+
+
+class GuideIndex:
+    """
+    Records of each guide, indexed by date. Built once per snapshot, so a guide's query
+    is a dict lookup instead of fuzzy matching every row. Matches of unchanged cells
+    are reused from the previous snapshots.
+    """
+
+    def __init__(self, records: list[OrderRecord]):
+        guide_records = defaultdict(list)
+        for record in records:
+            for guide_id in record_guides(record.cells):
+                guide_records[guide_id].append(record)
+
+        self._indexes = {guide_id: DateIndex(records) for guide_id, records in guide_records.items()}
+
+    def get(self, guide_id: int) -> DateIndex:
+        """ Records mentioning the guide. """
+        return self._indexes.get(guide_id) or DateIndex([])
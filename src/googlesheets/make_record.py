@@ -1,8 +1,26 @@
+import logging
+import threading
 from datetime import datetime
+from functools import lru_cache
+from typing import Optional, Sequence
 
-from src.googlesheets.docs_parsing import worksheet
+import gspread
 
-SHEET = worksheet
+from src.googlesheets.docs_parsing import SHEET_NAME, get_worksheet
+from src.googlesheets.index import RowPositions
+from src.googlesheets.quota import limiter
+from src.googlesheets.snapshot import SheetData, sheets_cache
+
+logger = logging.getLogger(__name__)
+
+# Rows re-read above and below the insert position to check that the snapshot is up to date there
+CHECK_WINDOW = 3
+
+# Background of the records added by the bot
+HIGHLIGHT = {'red': 1.0, 'green': 0.95, 'blue': 0.8}
+
+# One write at a time: positions found by a write are valid only until another write moves the rows
+_write_lock = threading.Lock()
 
 
 def parse_record(data: list) -> list:
@@ -63,7 +81,7 @@ def find_insert_index(data, new_datetime) -> int:
                 try:
                     next_row = data[j]
                     next_datetime = datetime.strptime(next_row[0] + ' ' + next_row[1], '%d.%m.%Y %H:%M') \
-                        if next_row[1] else datetime.strptime(row[0] + ' 00:00', '%d.%m.%Y %H:%M')
+                        if next_row[1] else datetime.strptime(next_row[0] + ' 00:00', '%d.%m.%Y %H:%M')
                     # Found a valid row, compare with it
                     if (new_datetime.year, new_datetime.month) < (next_datetime.year, next_datetime.month):
                         return i + 1  # Insert before the invalid block
@@ -77,21 +95,156 @@ def find_insert_index(data, new_datetime) -> int:
     return len(data) + 1
 
 
-def add_record(record_data, highlight: bool = False):
-    """ Inserts new record into Google Sheets."""
-    data = SHEET.get_all_values()
+@lru_cache(maxsize=1)
+def get_row_positions(orders: SheetData) -> RowPositions:
+    """ Built once per snapshot, on the first insert. """
+    return RowPositions(orders.records)
+
+
+def find_cached_insert_index(orders: SheetData, new_datetime: datetime) -> int:
+    """
+    Same position as find_insert_index, found with binary search over the snapshot:
+    before the first later row, or before the block of rows without a start
+    (e.g. a month title) that precedes it, if that row is in a later month.
+    """
+    next_record = get_row_positions(orders).first_after(new_datetime)
+    if next_record is None:
+        return len(orders.records) + 2
+
+    insert_index = next_record.row_number
+    if (new_datetime.year, new_datetime.month) < (next_record.date.year, next_record.date.month):
+        # records[i] is row i + 2; the header is never moved down
+        while insert_index > 2 and not RowPositions.has_start(orders.records[insert_index - 3]):
+            insert_index -= 1
+    return insert_index
+
+
+def window_range(insert_index: int) -> str:
+    """ Dates and times of the rows around the position. """
+    return f'A{max(2, insert_index - CHECK_WINDOW)}:B{insert_index + CHECK_WINDOW}'
+
+
+def window_matches(values: list[list], orders: SheetData, insert_index: int) -> bool:
+    """ Checks that the dates and times around the position are the same in the sheet as in the snapshot. """
+    first = max(2, insert_index - CHECK_WINDOW)
+    last = insert_index + CHECK_WINDOW
+
+    for row_number in range(first, last + 1):
+        row = list(values[row_number - first]) if row_number - first < len(values) else []
+        actual = (row + ['', ''])[:2]
+
+        record = orders.records[row_number - 2] if row_number - 2 < len(orders.records) else None
+        expected = [str(record.cells.get('Дата', '')), str(record.cells.get('Время', ''))] if record else ['', '']
 
-    # Find the right row
-    new_datetime = datetime.strptime(record_data[0] + ' ' + record_data[1], '%d.%m.%Y %H:%M')
-    insert_index = find_insert_index(data, new_datetime)
+        if actual != expected:
+            logger.info(f'Строка {row_number} изменилась после загрузки таблицы: {expected} -> {actual}')
+            return False
+    return True
 
-    new_record = parse_record(record_data)
-    SHEET.insert_row(new_record, insert_index)
 
-    # Highlight the record
+def get_insert_indexes(sheet: gspread.Worksheet, new_datetimes: list[datetime]) \
+        -> tuple[list[int], Optional[SheetData]]:
+    """
+    Positions from the snapshot, confirmed by reading a few rows around each of them in one request,
+    and the snapshot's data of the sheet. If they can't be trusted, the whole sheet is read
+    and no data is returned.
+    """
+    try:
+        orders = sheets_cache.get()[SHEET_NAME]
+    except Exception as e:
+        logger.error(f'Нет загруженной таблицы для поиска места записи: {e}')
+    else:
+        indexes = [find_cached_insert_index(orders, new_datetime) for new_datetime in new_datetimes]
+        windows = limiter.call(sheet.batch_get, [window_range(index) for index in indexes])
+        if all(window_matches(values, orders, index) for values, index in zip(windows, indexes)):
+            return indexes, orders
+
+    # The snapshot is out of date
+    data = limiter.call(sheet.get_all_values)
+    return [find_insert_index(data, new_datetime) for new_datetime in new_datetimes], None
+
+
+def record_datetime(record_data: list) -> datetime:
+    return datetime.strptime(record_data[0] + ' ' + record_data[1], '%d.%m.%Y %H:%M')
+
+
+def make_cell(value, highlight: bool) -> dict:
+    cell = {'userEnteredValue': {'stringValue': str(value)}}
     if highlight:
-        SHEET.format(f"A{insert_index}:L{insert_index}", {
-            "backgroundColor": {
-                "red": 1.0, "green": 0.95, "blue": 0.8
-            }
-        })
+        cell['userEnteredFormat'] = {'backgroundColor': HIGHLIGHT}
+    return cell
+
+
+def find_written(data: list[list], new_records: list[list]) -> list[bool]:
+    """ Whether each record is already in the sheet: a row starts with exactly its values. """
+    width = max(len(new_record) for new_record in new_records)
+    rows = {tuple((row + [''] * width)[:width]) for row in data[1:]}
+    return [tuple(map(str, new_record + [''] * (width - len(new_record)))) in rows for new_record in new_records]
+
+
+def add_records(records: list[tuple[list, bool]], uncertain: Sequence[bool] = ()) -> None:
+    """
+    Inserts new records into Google Sheets with one batch update: row insertions, values
+    and highlighting together. Takes (record_data, highlight) pairs.
+    Writes from the queue and from imports run one after another, from finding the rows to updating the snapshot.
+
+    Uncertain records (uncertain[i] is True) may have been written by an earlier attempt whose
+    response was lost, e.g. on a read timeout. The sheet is read first, and those found in it are skipped.
+    """
+    with _write_lock:
+        sheet = get_worksheet()
+        new_records = [parse_record(record_data) for record_data, _ in records]
+
+        if any(uncertain):
+            data = limiter.call(sheet.get_all_values)
+            written = find_written(data, new_records)
+            keep = [i for i in range(len(records)) if not (i < len(uncertain) and uncertain[i] and written[i])]
+            if len(keep) < len(records):
+                logger.info(f'{len(records) - len(keep)} записей уже есть в таблице, повторно не добавляются')
+            records = [records[i] for i in keep]
+            new_records = [new_records[i] for i in keep]
+            if not records:
+                sheets_cache.invalidate()
+                return
+
+            # Positions in the sheet just read
+            new_datetimes = [record_datetime(record_data) for record_data, _ in records]
+            insert_indexes = [find_insert_index(data, new_datetime) for new_datetime in new_datetimes]
+            orders = None
+        else:
+            # Find the right rows, all against the sheet as it is now
+            new_datetimes = [record_datetime(record_data) for record_data, _ in records]
+            insert_indexes, orders = get_insert_indexes(sheet, new_datetimes)
+
+        # From the bottom up, so an insertion doesn't move the rows of the following ones.
+        # Of two records going to the same row, the later one (or the one queued later)
+        # is inserted first and ends up below.
+        order = sorted(range(len(records)), key=lambda i: (insert_indexes[i], new_datetimes[i], i), reverse=True)
+
+        requests = []
+        for i in order:
+            _, highlight = records[i]
+            row = insert_indexes[i] - 1  # 0-based
+            requests.append({'insertDimension': {
+                'range': {'sheetId': sheet.id, 'dimension': 'ROWS', 'startIndex': row, 'endIndex': row + 1},
+                'inheritFromBefore': False,
+            }})
+            requests.append({'updateCells': {
+                'start': {'sheetId': sheet.id, 'rowIndex': row, 'columnIndex': 0},
+                'rows': [{'values': [make_cell(value, highlight) for value in new_records[i]]}],
+                'fields': 'userEnteredValue,userEnteredFormat.backgroundColor' if highlight else 'userEnteredValue',
+            }})
+
+        limiter.call(sheet.spreadsheet.batch_update, {'requests': requests})
+
+        # The next query must see the new orders: add them to the snapshot
+        # the positions were found in. The next refresh brings the sheet as Google has it.
+        if orders is not None:
+            headers = orders.headers
+            new_rows = [
+                (insert_indexes[i], new_datetimes[i], dict(zip(headers, new_records[i] + [''] * len(headers))))
+                for i in range(len(records))
+            ]
+            if sheets_cache.update(SHEET_NAME, orders, orders.with_rows(new_rows)):
+                return
+        sheets_cache.invalidate()
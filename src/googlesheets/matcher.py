@@ -0,0 +1,77 @@
+import re
+from collections import Counter
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+# Same similarity threshold as difflib.get_close_matches used before
+CUTOFF = 0.7
+
+_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def normalize(text: str) -> str:
+    """ Lower case, 'ё' as 'е'. """
+    return text.strip().lower().replace('ё', 'е')
+
+
+def tokenize(text: str) -> list[str]:
+    """ Splits a cell into normalised words, punctuation is a separator. """
+    return [token for token in _SEPARATORS.split(normalize(text)) if token]
+
+
+class NameMatcher:
+    """
+    Typo-tolerant recognition of guide names.
+
+    A token matches a name when difflib's similarity ratio is at least CUTOFF, as with
+    get_close_matches. Cheap upper bounds of the ratio (by length and by common letters)
+    reject most names before SequenceMatcher runs, and results are cached per token and per cell.
+    """
+
+    def __init__(self, guides: dict[int, dict]):
+        self._names = [
+            (guide_id, name, len(name), str.maketrans('', '', name), Counter(name))
+            for guide_id, guide in guides.items()
+            for name in map(normalize, (guide['name'], guide.get('stage_name', ''), *guide.get('aliases', ())))
+            if name
+        ]
+        self.match_token = lru_cache(maxsize=4096)(self._match_token)
+        self.find = lru_cache(maxsize=4096)(self._find)
+
+    def _match_token(self, token: str) -> frozenset[int]:
+        """ Ids of the guides whose name or stage name is similar to the token. """
+        matched = set()
+        token_len = len(token)
+        token_letters = sequence_matcher = None
+
+        for guide_id, name, name_len, name_table, name_letters in self._names:
+            if guide_id in matched:
+                continue
+            if token == name:
+                matched.add(guide_id)
+                continue
+            total = token_len + name_len
+            # Upper bound by length: all letters of the shorter word match
+            if 2.0 * min(token_len, name_len) / total < CUTOFF:
+                continue
+            # Upper bounds by common letters, regardless of their order: first without
+            # the token's letters missing from the name, then counting repeated letters
+            if 2.0 * (token_len - len(token.translate(name_table))) / total < CUTOFF:
+                continue
+            if token_letters is None:
+                token_letters = Counter(token)
+            if 2.0 * sum((token_letters & name_letters).values()) / total < CUTOFF:
+                continue
+            if sequence_matcher is None:
+                # seq2 is the token, as in get_close_matches: its analysis is reused for all names
+                sequence_matcher = SequenceMatcher()
+                sequence_matcher.set_seq2(token)
+            sequence_matcher.set_seq1(name)
+            if sequence_matcher.ratio() >= CUTOFF:
+                matched.add(guide_id)
+
+        return frozenset(matched)
+
+    def _find(self, text: str) -> frozenset[int]:
+        """ Ids of the guides mentioned in the text. """
+        return frozenset().union(*(self.match_token(token) for token in tokenize(text)))
@@ -0,0 +1,209 @@
+import json
+import logging
+import sqlite3
+from datetime import date, datetime
+from operator import attrgetter
+from typing import Iterable, Iterator, Optional
+
+from src.config import config
+from src.googlesheets.guides import record_guides
+from src.googlesheets.records import OrderRecord
+from src.googlesheets.snapshot import SheetData, Snapshot, sheets_cache
+
+logger = logging.getLogger(__name__)
+
+
+# =================== Schema ===================
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(config.db_path)
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS order_sheets (
+        sheet TEXT PRIMARY KEY,
+        headers TEXT NOT NULL,
+        synced_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS orders (
+        sheet TEXT NOT NULL,
+        row_number INTEGER NOT NULL,
+        date TEXT,
+        cells TEXT NOT NULL,
+        PRIMARY KEY (sheet, row_number)
+    );
+    CREATE INDEX IF NOT EXISTS orders_by_date ON orders (sheet, date);
+    CREATE TABLE IF NOT EXISTS order_guides (
+        guide_id INTEGER NOT NULL,
+        sheet TEXT NOT NULL,
+        date TEXT NOT NULL,
+        row_number INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS order_guides_by_date ON order_guides (guide_id, sheet, date);
+    """)
+    return conn
+
+
+# =================== Sync ===================
+# Sheet name -> data now stored in the mirror. Only the sync thread changes it.
+_mirrored: dict[str, SheetData] = {}
+
+
+def _order_row(name: str, record: OrderRecord) -> tuple:
+    return (name, record.row_number, record.date and record.date.isoformat(),
+            json.dumps(record.cells, ensure_ascii=False))
+
+
+def _guide_rows(name: str, records: Iterable[OrderRecord]) -> Iterator[tuple]:
+    return ((guide_id, name, record.date.isoformat(), record.row_number)
+            for record in records if record.date
+            for guide_id in record_guides(record.cells))
+
+
+def _replace_sheet(conn: sqlite3.Connection, name: str, data: SheetData) -> None:
+    """ Writes all rows of the sheet in place of the old ones. """
+    conn.execute('DELETE FROM orders WHERE sheet = ?', (name,))
+    conn.execute('DELETE FROM order_guides WHERE sheet = ?', (name,))
+    conn.executemany('INSERT INTO orders (sheet, row_number, date, cells) VALUES (?, ?, ?, ?)',
+                     (_order_row(name, record) for record in data.records))
+    conn.executemany('INSERT INTO order_guides (guide_id, sheet, date, row_number) VALUES (?, ?, ?, ?)',
+                     _guide_rows(name, data.records))
+
+
+def _insert_rows(conn: sqlite3.Connection, name: str, data: SheetData) -> None:
+    """ Adds the rows inserted by the bot, moving the rows below each of them one row down. """
+    for row_number in data.inserted:
+        # Through negative numbers, so no row takes a number that is still in use
+        conn.execute('UPDATE orders SET row_number = -(row_number + 1) WHERE sheet = ? AND row_number >= ?',
+                     (name, row_number))
+        conn.execute('UPDATE orders SET row_number = -row_number WHERE sheet = ? AND row_number < 0', (name,))
+        conn.execute('UPDATE order_guides SET row_number = row_number + 1 WHERE sheet = ? AND row_number >= ?',
+                     (name, row_number))
+
+        record = data.records[row_number - 2]
+        conn.execute('INSERT INTO orders (sheet, row_number, date, cells) VALUES (?, ?, ?, ?)',
+                     _order_row(name, record))
+        conn.executemany('INSERT INTO order_guides (guide_id, sheet, date, row_number) VALUES (?, ?, ?, ?)',
+                         _guide_rows(name, [record]))
+
+
+def sync_mirror(snapshot: Snapshot, previous: Optional[Snapshot] = None) -> None:
+    """
+    Copies the sheets of a new snapshot to SQLite. Sheets already in the mirror are left as they are.
+    Rows inserted by the bot are added one by one; downloaded sheets are written in full.
+    """
+    changed = {}
+    conn = _connect()
+    try:
+        with conn:
+            for name, data in snapshot.sources.items():
+                if _mirrored.get(name) is data:
+                    continue
+
+                # A sheet with inserted rows is new in this version and made from the previous version's sheet
+                base = previous.sources.get(name) if previous else None
+                if data.inserted is not None and base is not None and _mirrored.get(name) is base:
+                    _insert_rows(conn, name, data)
+                else:
+                    _replace_sheet(conn, name, data)
+                conn.execute(
+                    'INSERT OR REPLACE INTO order_sheets (sheet, headers, synced_at) VALUES (?, ?, ?)',
+                    (name, json.dumps(data.headers, ensure_ascii=False), data.fetched_at.isoformat(timespec='seconds'))
+                )
+                changed[name] = data
+    finally:
+        conn.close()
+    # Only after the commit: a failed sync is done again in full
+    _mirrored.update(changed)
+    logger.debug(f'Orders mirror synced with snapshot v{snapshot.version}')
+
+
+# Every downloaded snapshot is mirrored
+sheets_cache.add_listener(sync_mirror)
+
+
+# =================== Queries ===================
+class MirrorIndex:
+    """ Same lookups as DateIndex, answered with indexed SQL queries to the mirror. """
+
+    def __init__(self, sheet_name: str, guide_id: Optional[int] = None):
+        self.sheet_name = sheet_name
+        self.guide_id = guide_id
+
+    def between(self, start_date: date, end_date: Optional[date] = None) -> list[OrderRecord]:
+        """ Records from start_date to end_date inclusive. Without end_date - up to the end of the sheet. """
+        if self.guide_id:
+            query = ('SELECT o.row_number, o.cells FROM order_guides g '
+                     'JOIN orders o ON o.sheet = g.sheet AND o.row_number = g.row_number '
+                     'WHERE g.guide_id = ? AND g.sheet = ? AND g.date >= ?')
+            params = [self.guide_id, self.sheet_name, start_date.isoformat()]
+            date_column = 'g.date'
+        else:
+            query = 'SELECT o.row_number, o.cells FROM orders o WHERE o.sheet = ? AND o.date >= ?'
+            params = [self.sheet_name, start_date.isoformat()]
+            date_column = 'o.date'
+
+        if end_date:
+            query += f' AND {date_column} <= ?'
+            params.append(end_date.isoformat())
+        query += f' ORDER BY {date_column}, o.row_number'
+
+        conn = _connect()
+        try:
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+        # Same order as DateIndex: the time is only known after parsing the cells
+        records = [OrderRecord(row_number, json.loads(cells)) for row_number, cells in rows]
+        records.sort(key=attrgetter('sort_key'))
+        return records
+
+
+class MirrorGuideIndex:
+    """ Same lookups as GuideIndex, answered by the mirror. """
+
+    def __init__(self, sheet_name: str):
+        self.sheet_name = sheet_name
+
+    def get(self, guide_id: int) -> MirrorIndex:
+        return MirrorIndex(self.sheet_name, guide_id)
+
+
+class MirrorSheet:
+    """ A sheet stored in the mirror, in place of SheetData. Rows are read only by index queries. """
+
+    def __init__(self, sheet_name: str, headers: list[str], fetched_at: datetime):
+        self.headers = headers
+        self.fetched_at = fetched_at
+        self.date_index = MirrorIndex(sheet_name)
+        self.guide_index = MirrorGuideIndex(sheet_name)
+
+
+def load_mirror() -> Optional[Snapshot]:
+    """ Snapshot answering queries from the mirror, or None if nothing has been mirrored yet. """
+    conn = _connect()
+    try:
+        sheets = conn.execute('SELECT sheet, headers, synced_at FROM order_sheets').fetchall()
+    finally:
+        conn.close()
+    if not sheets:
+        return None
+
+    sources = {
+        name: MirrorSheet(name, json.loads(headers), datetime.fromisoformat(synced_at))
+        for name, headers, synced_at in sheets
+    }
+    return Snapshot(sources, version=0, stale=True)
+
+
+def get_snapshot() -> Snapshot:
+    """
+    The cached snapshot of the sheets. If Google Sheets can't be loaded,
+    queries are answered from the local mirror of the last downloaded data.
+    """
+    try:
+        return sheets_cache.get()
+    except Exception as e:
+        snapshot = load_mirror()
+        if snapshot is None:
+            raise
+        logger.error(f'Google таблицы недоступны, используется локальная копия от '
+                     f'{snapshot.data_time:%d.%m.%Y %H:%M}: {e}')
+        return snapshot
@@ -1,75 +1,63 @@
 import logging
+from functools import partial
+from typing import Optional
 
 import gspread
-from environs import Env
 
-from src.config import config
-
-env = Env()
-env.read_env('.env')
+from src.googlesheets.client import open_worksheet
+from src.googlesheets.guides import PERSONAL_SHEETS
+from src.googlesheets.index import DateIndex
+from src.googlesheets.projection import View
+from src.googlesheets.quota import limiter
+from src.googlesheets.snapshot import Snapshot, register_source, sheets_cache
 
 logger = logging.getLogger(__name__)
 
-gc = gspread.service_account(filename=config.credential_file)
+# Links to the guides' Google Sheets, from the guide registry
+sheet_urls = {sheet['name']: sheet['url'] for sheet in PERSONAL_SHEETS.values()}
 
-# Opening a Google Sheet via a links
-sheet_urls = {
-    'Маркова': env('SPREADSHEET_M_URL'),
-    'Путятина': env('SPREADSHEET_P_URL')
-}
 
-worksheets = {
-    name: gc.open_by_url(url).worksheet(name)
-    for name, url in sheet_urls.items()
-}
+# Sheets are opened on first use
+def get_worksheet(sheet_name: str) -> gspread.Worksheet:
+    return open_worksheet(sheet_urls[sheet_name], sheet_name)
 
 
-# Get data from google sheet
-def get_extra_orders(sheet_name: str) -> list[dict[str, int | float | str]]:
-    worksheet = worksheets[sheet_name]
-    data = worksheet.get_all_records()
+# Download data from google sheet
+def fetch_extra_orders(sheet_name: str) -> list[dict[str, int | float | str]]:
+    data = limiter.call(get_worksheet(sheet_name).get_all_records)
     if not data:
         logger.error(f"Гугл таблица '{sheet_name}' пуста или недоступна.")
         raise ValueError(f"Таблица '{sheet_name}' пуста или недоступна.")
     return data
 
 
-# Cash data
-cached_data = {
-    name: get_extra_orders(name) for name in worksheets
-}
-
+# The sheets are downloaded concurrently with the main order sheet
+for name in sheet_urls:
+    register_source(name, partial(fetch_extra_orders, name))
 
-# Get columns
-def get_columns(sheet_name: str, column_ranges: list[tuple[int, int]]) -> list[str]:
-    headers = list(cached_data[sheet_name][0])
-    return [
-        header
-        for start, end in column_ranges
-        for header in headers[start:end]
-    ]
 
+# Get data from the cached snapshot indexed by date
+def get_extra_orders_index(sheet_name: str, snapshot: Optional[Snapshot] = None) -> DateIndex:
+    return (snapshot or sheets_cache.get())[sheet_name].date_index
 
-# Get data for Маркова
-def get_admin_mcolumns() -> list[str]:
-    return get_columns('Маркова', [(0, 5), (6, 7), (8, 9)])
 
+# =================== Views ===================
+# Columns shown for a period, if the registry doesn't set them
+BRIEF_COLUMNS = ((0, 3), (6, 7))
 
-# All columns for Маркова
-def get_m_columns() -> list[str]:
-    return get_columns('Маркова', [(0, 3), (4, 7), (8, 9)])
 
+def sheet_view(sheet_name: str, column_ranges: list[list[int]]) -> View:
+    return ((sheet_name, tuple((start, end) for start, end in column_ranges)),)
 
-# Get data for Путятина
-def get_admin_pcolumns() -> list[str]:
-    return get_columns('Путятина', [(0, 5), (6, 7), (8, 9)])
-
-
-# All columns for Путятина
-def get_p_columns() -> list[str]:
-    return get_columns('Путятина', [(0, 3), (4, 7), (8, 10)])
 
+# All columns of each personal sheet, for a day
+PERSONAL_VIEWS: dict[str, View] = {
+    sheet['name']: sheet_view(sheet['name'], sheet['columns'])
+    for sheet in PERSONAL_SHEETS.values()
+}
 
-# Reduced columns for both guids
-def get_brief_mpcols() -> list[str]:
-    return get_columns('Путятина', [(0, 3), (6, 7)])
+# Reduced columns of each personal sheet, for a period
+BRIEF_PERSONAL_VIEWS: dict[str, View] = {
+    sheet['name']: sheet_view(sheet['name'], sheet.get('brief_columns', BRIEF_COLUMNS))
+    for sheet in PERSONAL_SHEETS.values()
+}
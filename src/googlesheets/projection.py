@@ -0,0 +1,42 @@
+from functools import lru_cache
+from typing import Iterable
+
+from src.googlesheets.records import OrderRecord
+
+# A view is a list of columns for the output: pairs of (sheet whose headers name the columns,
+# column ranges in that sheet). Views are tuples, so they can be used as dict keys.
+View = tuple[tuple[str, tuple[tuple[int, int], ...]], ...]
+
+
+def select_columns(headers: list[str], column_ranges: Iterable[tuple[int, int]]) -> list[str]:
+    """ Column names of the ranges. """
+    return [
+        header
+        for start, end in column_ranges
+        for header in headers[start:end]
+    ]
+
+
+class Projection:
+    """
+    Columns of a sheet selected for a view, compiled to positions in the row.
+    Applying it to a record is a plain loop over the positions, with no lookups in column lists.
+    """
+
+    __slots__ = ('columns',)
+
+    def __init__(self, headers: tuple[str, ...], columns: tuple[str, ...]):
+        selected = set(columns)
+        # Keep the order of the sheet, as the filtered dicts always did
+        self.columns = tuple((position, header) for position, header in enumerate(headers) if header in selected)
+
+    def __call__(self, record: OrderRecord) -> dict:
+        """ Non-empty cells of the selected columns. """
+        values = record.values
+        return {header: values[position] for position, header in self.columns if values[position]}
+
+
+@lru_cache(maxsize=128)
+def compile_projection(headers: tuple[str, ...], columns: tuple[str, ...]) -> Projection:
+    """ Compiled once per sheet schema and list of columns, and reused by the following snapshots. """
+    return Projection(headers, columns)
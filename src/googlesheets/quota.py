@@ -0,0 +1,195 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Callable, Iterator, TypeVar
+
+from gspread.exceptions import APIError
+
+from src.config import config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class Priority(IntEnum):
+    """ Who is waiting for a Google Sheets call. Lower value - served first. """
+    INTERACTIVE = 0  # a user pressed a button
+    SCHEDULED = 1  # notifications
+    BACKGROUND = 2  # snapshot refreshes and retries
+
+
+class PriorityLevel:
+    """
+    Priority of the calls of one block. The threads the block's context is copied into share it,
+    so it can be raised while their calls wait, e.g. when a user starts waiting for the block.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value: Priority):
+        self.value = value
+
+
+# Priority of the calls made in the current context. Copied into the thread pools with the context.
+_priority: contextvars.ContextVar[PriorityLevel] = contextvars.ContextVar(
+    'sheets_priority', default=PriorityLevel(Priority.INTERACTIVE)
+)
+
+# Share of the bucket kept for more urgent calls: background calls never take the last quarter of it
+_RESERVE = {Priority.INTERACTIVE: 0.0, Priority.SCHEDULED: 0.1, Priority.BACKGROUND: 0.25}
+
+# Responses meaning the request was not processed and can be repeated
+_RETRY_STATUSES = (429, 503)
+_MAX_ATTEMPTS = 4
+_RETRY_DELAY = 2.0
+
+
+@contextmanager
+def priority(level: Priority) -> Iterator[PriorityLevel]:
+    """ Runs the Google Sheets calls of the block with the given priority. """
+    token = _priority.set(PriorityLevel(level))
+    try:
+        yield _priority.get()
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> Priority:
+    """ Priority of the calls made in the current context. """
+    return _priority.get().value
+
+
+def _retry_after(error: APIError) -> float | None:
+    """ Seconds from the Retry-After header of the response, if there is one. """
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def response_status(error: APIError) -> int | None:
+    """ HTTP status of the failed request. """
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class QuotaLimiter:
+    """
+    Token bucket shared by all Google Sheets calls of the bot.
+
+    The bucket holds a minute of the quota and refills evenly. Waiting calls are served
+    by priority, and lower priorities leave a reserve of tokens for the higher ones.
+    After a 429 response no call is made until Retry-After has passed.
+    """
+
+    def __init__(self, per_minute: int):
+        if per_minute < 1:
+            raise ValueError(f'Квота Google Sheets должна быть не меньше 1 запроса в минуту: {per_minute}')
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting = Counter()
+        self._condition = threading.Condition()
+        self._stats = Counter()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _threshold(self, level: Priority) -> float:
+        """ Tokens needed to take one at the level. Never above the capacity, or the call would wait forever. """
+        return min(self.capacity, 1 + _RESERVE[level] * self.capacity)
+
+    def _can_take(self, level: Priority, now: float) -> bool:
+        if now < self._blocked_until:
+            return False
+        if any(self._waiting[other] for other in Priority if other < level):
+            return False
+        return self._tokens >= self._threshold(level)
+
+    def acquire(self, priority_level: PriorityLevel) -> Priority:
+        """ Waits for a token. Returns the priority it was given with. """
+        start = time.monotonic()
+        with self._condition:
+            level = priority_level.value
+            self._waiting[level] += 1
+            try:
+                while True:
+                    if priority_level.value != level:
+                        # Raised while waiting
+                        self._waiting[level] -= 1
+                        level = priority_level.value
+                        self._waiting[level] += 1
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._can_take(level, now):
+                        self._tokens -= 1
+                        break
+                    needed = self._threshold(level) - self._tokens
+                    delay = max(self._blocked_until - now, needed / self.rate, 0.05)
+                    self._condition.wait(delay)
+            finally:
+                self._waiting[level] -= 1
+                # A waiter of lower priority may go now
+                self._condition.notify_all()
+
+        waited = time.monotonic() - start
+        self._stats[f'calls_{level.name.lower()}'] += 1
+        if waited > 0.01:
+            self._stats['waits'] += 1
+            self._stats['wait_seconds'] += waited
+        return level
+
+    def raise_priority(self, priority_level: PriorityLevel, level: Priority) -> None:
+        """ Gives the calls of a block at least the priority, including the ones already waiting. """
+        with self._condition:
+            if level < priority_level.value:
+                priority_level.value = level
+                self._condition.notify_all()
+
+    def throttle(self, delay: float) -> None:
+        """ Stops all calls for the delay, e.g. after a 429 response. """
+        with self._condition:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._tokens = 0.0
+            self._stats['throttled'] += 1
+
+    def call(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Calls gspread within the quota, with the priority of the current context.
+        Requests rejected by Google as over quota or unavailable are repeated with backoff.
+        """
+        priority_level = _priority.get()
+        for attempt in range(_MAX_ATTEMPTS):
+            self.acquire(priority_level)
+            try:
+                return func(*args, **kwargs)
+            except APIError as e:
+                if response_status(e) not in _RETRY_STATUSES or attempt == _MAX_ATTEMPTS - 1:
+                    self._stats['errors'] += 1
+                    raise
+                delay = _retry_after(e) or _RETRY_DELAY * 2 ** attempt
+                logger.warning(f'Google Sheets: ответ {response_status(e)}, повтор {func.__name__} через {delay:.0f} с')
+                self._stats['retries'] += 1
+                if response_status(e) == 429:
+                    self.throttle(delay)
+                else:
+                    time.sleep(delay)
+
+    def stats(self) -> dict[str, float]:
+        """ Counters of quota use since the start, with the tokens left now. """
+        with self._condition:
+            self._refill(time.monotonic())
+            return {**self._stats, 'tokens': round(self._tokens, 1), 'capacity': self.capacity}
+
+
+# All Google Sheets calls of the bot go through this limiter
+limiter = QuotaLimiter(config.sheets_quota)
@@ -0,0 +1,60 @@
+from datetime import date, datetime, time
+from typing import Optional
+
+
+def format_date(str_date: str) -> date:
+    """ Date formation """
+    try:
+        pattern = '%d.%m.%Y'
+        return datetime.strptime(str_date, pattern).date()
+    except (ValueError, TypeError):
+        pass
+
+
+def format_time(str_time: str) -> Optional[time]:
+    """ Start time from the 'Время' column: 'ЧЧ:ММ', 'ЧЧ:ММ:СС' or a period 'ЧЧ:ММ-ЧЧ:ММ'. """
+    try:
+        # Handle period in Time column
+        time_start = str_time.strip().split('-')[0].strip()
+        if len(time_start.split(':')) == 3:
+            time_start = ':'.join(time_start.split(':')[:2])
+        return datetime.strptime(time_start, '%H:%M').time()
+    except (ValueError, AttributeError):
+        return None
+
+
+class OrderRecord:
+    """
+    One row of an order sheet. Date and start time are parsed once, when the snapshot is loaded.
+    Rows with a missing or invalid time are kept with the time_error flag set.
+    """
+
+    __slots__ = ('row_number', 'cells', 'values', 'date', 'start', 'time_error', 'sort_key')
+
+    def __init__(self, row_number: int, cells: dict[str, int | float | str]):
+        self.row_number = row_number  # row number in the sheet, the header is row 1
+        self.cells = cells
+        self.values = tuple(cells.values())  # in the order of the sheet headers
+        self.date = format_date(cells.get('Дата'))
+        self.start = format_time(cells.get('Время'))
+        self.time_error = self.start is None
+        # Order of the tours: by date and start time. Rows without time go first in their day.
+        self.sort_key = (self.date, self.start or time.min)
+
+    def moved(self, row_number: int) -> 'OrderRecord':
+        """ The same row at another position in the sheet, without parsing it again. """
+        record = OrderRecord.__new__(OrderRecord)
+        for slot in self.__slots__:
+            setattr(record, slot, getattr(self, slot))
+        record.row_number = row_number
+        return record
+
+    @property
+    def error_text(self) -> str:
+        """ Short description of the row for error messages. """
+        return ' - '.join([str(self.cells.get('Дата', '')), str(self.cells.get('Программа', ''))])
+
+
+def make_records(rows: list[dict]) -> list[OrderRecord]:
+    """ Parses rows returned by get_all_records(). """
+    return [OrderRecord(number, row) for number, row in enumerate(rows, start=2)]
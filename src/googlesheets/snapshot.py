@@ -0,0 +1,366 @@
+import contextvars
+import logging
+import mmap
+import os
+import pickle
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable
+
+from src.config import config
+from src.googlesheets.index import DateIndex, GuideIndex
+from src.googlesheets.projection import Projection, View, compile_projection, select_columns
+from src.googlesheets.quota import Priority, PriorityLevel, current_priority, limiter, priority
+from src.googlesheets.records import OrderRecord, make_records
+
+logger = logging.getLogger(__name__)
+
+
+class SheetData:
+    """ Rows of one sheet with their parsed records and indexes. """
+
+    def __init__(self, rows: list[dict], records: list[OrderRecord] | None = None):
+        self.rows = rows
+        self.fetched_at = datetime.now()
+        self.records = make_records(rows) if records is None else records
+        self.date_index = DateIndex(self.records)
+        self.guide_index = GuideIndex(self.records)
+        # Row numbers of the rows added by with_rows, None for a downloaded sheet
+        self.inserted: tuple[int, ...] | None = None
+
+    @property
+    def headers(self) -> list[str]:
+        return list(self.rows[0]) if self.rows else []
+
+    def with_rows(self, new_rows: list[tuple[int, datetime, dict]]) -> 'SheetData':
+        """
+        Copy of the sheet with rows inserted as the bot inserts them: (row number before the insertion,
+        start, cells). Rows going to the same place are ordered by start, then as given. Only the new rows are parsed.
+        """
+        pending = sorted(new_rows, key=lambda new_row: new_row[:2])
+        rows, records, inserted = [], [], []
+
+        def append(cells: dict, record: OrderRecord | None = None) -> None:
+            row_number = len(records) + 2
+            if record is None:
+                record = OrderRecord(row_number, cells)
+                inserted.append(row_number)
+            elif record.row_number != row_number:
+                record = record.moved(row_number)
+            rows.append(cells)
+            records.append(record)
+
+        position = 0
+        for record in self.records:
+            while position < len(pending) and pending[position][0] <= record.row_number:
+                append(pending[position][2])
+                position += 1
+            append(record.cells, record)
+        for _, _, cells in pending[position:]:
+            append(cells)
+
+        data = SheetData(rows, records)
+        # The rest of the sheet is as old as it was
+        data.fetched_at = self.fetched_at
+        data.inserted = tuple(inserted)
+        return data
+
+
+class Snapshot:
+    """
+    In-memory copy of all order sheets taken in one refresh.
+    A stale snapshot holds data that could not be refreshed from Google Sheets.
+    """
+
+    def __init__(self, sources: dict[str, SheetData], version: int, stale: bool = False):
+        self.sources = sources
+        self.version = version
+        self.stale = stale
+        self.loaded_at = datetime.now()
+        self._projections: dict[tuple[str, View], Projection] = {}
+
+    def __getstate__(self) -> dict:
+        # Projections are added by readers at any time and are cheap to compile again
+        state = self.__dict__.copy()
+        state['_projections'] = {}
+        return state
+
+    @property
+    def data_time(self) -> datetime:
+        """ When the oldest of the sheets was downloaded. """
+        return min((data.fetched_at for data in self.sources.values()), default=self.loaded_at)
+
+    def __getitem__(self, sheet_name: str) -> SheetData:
+        return self.sources[sheet_name]
+
+    def columns(self, view: View) -> list[str]:
+        """ Column names of the view. """
+        return [
+            column
+            for sheet_name, column_ranges in view
+            for column in select_columns(self[sheet_name].headers, column_ranges)
+        ]
+
+    def projection(self, sheet_name: str, view: View) -> Projection:
+        """ Projection of the sheet's records onto the view, compiled once per snapshot. """
+        key = (sheet_name, view)
+        if key not in self._projections:
+            headers = tuple(self[sheet_name].headers)
+            self._projections[key] = compile_projection(headers, tuple(self.columns(view)))
+        return self._projections[key]
+
+
+# =================== Sources ===================
+# Sheet name -> function downloading its rows. Filled in by docs_parsing and mydocs_parsing.
+_fetchers: dict[str, Callable[[], list[dict]]] = {}
+
+# Separate from the handlers' pool: a refresh started from there must not wait for its own threads
+_fetch_pool = ThreadPoolExecutor(max_workers=config.sheets_workers, thread_name_prefix='gsheets-fetch')
+
+# Listeners of new snapshots run here, off the cache lock. One thread keeps them in the order of versions.
+_listener_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gsheets-listeners')
+
+
+def register_source(sheet_name: str, fetch: Callable[[], list[dict]]) -> None:
+    """ Adds a sheet to the snapshot. """
+    _fetchers[sheet_name] = fetch
+
+
+def fetch_sources() -> dict[str, list[dict] | Exception]:
+    """
+    Downloads all registered sheets concurrently, in one round of requests.
+    A sheet that failed to load is returned as its exception.
+    """
+    # Each fetch runs in a copy of the caller's context, so it keeps the caller's quota priority
+    futures = {name: _fetch_pool.submit(contextvars.copy_context().run, fetch) for name, fetch in _fetchers.items()}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            results[name] = e
+    return results
+
+
+# =================== Cache ===================
+# Delay before the first retry of a failed refresh, doubled after each failure up to the TTL
+RETRY_DELAY = 5
+
+
+class SnapshotCache:
+    """
+    Versioned TTL cache of the order sheets.
+
+    Readers get the current snapshot while it is fresh. An expired snapshot is reloaded
+    on the next read; concurrent readers wait for one download instead of starting their own.
+
+    If a refresh fails, readers keep getting the last good data, marked as stale, without waiting,
+    and the refresh is retried in the background with exponential backoff.
+    """
+
+    def __init__(self, loader: Callable[[], dict[str, list[dict] | Exception]], ttl: int):
+        self.ttl = ttl
+        self._loader = loader
+        self._snapshot: Snapshot | None = None
+        self._version = 0
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        # Priorities of the callers waiting for the lock and of the calls of the refresh holding it
+        self._priority_lock = threading.Lock()
+        self._waiting: Counter[Priority] = Counter()
+        self._refresh_priority: PriorityLevel | None = None
+        self._failures = 0
+        self._error: Exception | None = None
+        self._retry: threading.Timer | None = None
+        self._listeners: list[Callable[[Snapshot, Snapshot | None], None]] = []
+
+    def add_listener(self, listener: Callable[[Snapshot, Snapshot | None], None]) -> None:
+        """
+        Calls the listener with the new and the previous snapshot after each new version, in the background.
+        Versions reach the listener one by one, in order.
+        """
+        self._listeners.append(listener)
+
+    def _is_fresh(self) -> bool:
+        return self._snapshot is not None and time.monotonic() < self._expires_at
+
+    def get(self) -> Snapshot:
+        """ Returns the current snapshot, reloading it if it has expired. """
+        if self._is_fresh():
+            return self._snapshot
+        # A refresh has failed and is being retried in the background
+        if self._retry is not None:
+            if self._snapshot is not None:
+                return self._snapshot
+            raise self._error
+        return self.refresh(force=False)
+
+    def refresh(self, force: bool = True) -> Snapshot:
+        """
+        Downloads all sheets and replaces the snapshot.
+        A sheet that failed to load keeps its data from the previous snapshot, if there is one.
+        """
+        level = current_priority()
+        with self._priority_lock:
+            self._waiting[level] += 1
+            if self._refresh_priority is not None:
+                # The caller waits for the running refresh, so its calls become as urgent as the caller
+                limiter.raise_priority(self._refresh_priority, level)
+        with self._lock, priority(level) as refresh_priority:
+            with self._priority_lock:
+                self._waiting[level] -= 1
+                # Callers that queued up behind the lock earlier wait for this refresh too
+                limiter.raise_priority(refresh_priority, min(+self._waiting, default=level))
+                self._refresh_priority = refresh_priority
+            try:
+                return self._refresh(force)
+            finally:
+                with self._priority_lock:
+                    self._refresh_priority = None
+
+    def _refresh(self, force: bool) -> Snapshot:
+        """ Refresh under the lock. """
+        # Another thread may have reloaded the sheets while we were waiting
+        if not force and self._is_fresh():
+            return self._snapshot
+
+        previous = self._snapshot
+        sources = {}
+        errors = []
+        for name, rows in self._loader().items():
+            if not isinstance(rows, Exception):
+                sources[name] = SheetData(rows)
+                continue
+            errors.append(rows)
+            if previous and name in previous.sources:
+                logger.error(f"Таблица '{name}' не обновлена, используются прежние данные: {rows}")
+                sources[name] = previous.sources[name]
+            else:
+                self._schedule_retry(rows)
+                raise rows
+
+        if errors:
+            self._schedule_retry(errors[0])
+        else:
+            self._reset_retry()
+
+        self._expires_at = time.monotonic() + self.ttl
+        return self._publish(sources, bool(errors))
+
+    def update(self, sheet_name: str, expected: SheetData, data: SheetData) -> bool:
+        """
+        Replaces a sheet after the bot has changed it, so the change is seen without a download.
+        Only if the snapshot still holds the expected data of the sheet: a refresh in between
+        may or may not contain the change. The snapshot keeps its expiry time.
+        """
+        with self._lock:
+            if self._snapshot is None or self._snapshot.sources.get(sheet_name) is not expected:
+                return False
+            self._publish({**self._snapshot.sources, sheet_name: data}, self._snapshot.stale)
+            return True
+
+    def _publish(self, sources: dict[str, SheetData], stale: bool) -> Snapshot:
+        """ Makes a new version of the snapshot current. Called under the lock. """
+        previous = self._snapshot
+        self._version += 1
+        self._snapshot = Snapshot(sources, self._version, stale=stale)
+        logger.debug(f"Snapshot v{self._version}: " +
+                     ', '.join(f'{name} - {len(data.rows)} rows' for name, data in sources.items()))
+
+        if self._listeners:
+            _listener_pool.submit(self._notify, self._snapshot, previous)
+        return self._snapshot
+
+    def _notify(self, snapshot: Snapshot, previous: Snapshot | None) -> None:
+        for listener in self._listeners:
+            try:
+                listener(snapshot, previous)
+            except Exception as e:
+                logger.error(f'Ошибка обработчика обновления таблиц {listener.__name__}: {e}')
+
+    def _schedule_retry(self, error: Exception) -> None:
+        """ Schedules the next refresh attempt. Called under the lock. """
+        if self._retry is not None:
+            self._retry.cancel()
+        delay = min(RETRY_DELAY * 2 ** self._failures, self.ttl)
+        self._failures += 1
+        self._error = error
+        self._retry = threading.Timer(delay, self._run_retry)
+        self._retry.daemon = True
+        self._retry.start()
+        logger.warning(f'Повторная загрузка таблиц через {delay} с (попытка {self._failures})')
+
+    def _reset_retry(self) -> None:
+        """ Called under the lock after a successful refresh. """
+        if self._retry is not None:
+            self._retry.cancel()
+            logger.info(f'Таблицы снова загружены после {self._failures} неудачных попыток')
+        self._retry = None
+        self._failures = 0
+        self._error = None
+
+    def background_refresh(self) -> Snapshot:
+        """ Refresh that nobody is waiting for: its calls leave the quota to users first. """
+        with priority(Priority.BACKGROUND):
+            return self.refresh()
+
+    def _run_retry(self) -> None:
+        try:
+            self.background_refresh()
+        except Exception as e:
+            # The next attempt is already scheduled by refresh()
+            logger.error(f'Повторная загрузка таблиц не удалась: {e}')
+
+    def restore(self, snapshot: Snapshot) -> None:
+        """ Serves a snapshot saved before the restart until the next refresh. """
+        with self._lock:
+            if self._snapshot is not None:
+                return
+            self._snapshot = snapshot
+            self._version = snapshot.version
+            self._expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self) -> None:
+        """ Marks the snapshot as expired, e.g. after writing to a sheet. """
+        self._expires_at = 0.0
+
+
+# =================== Persistence ===================
+# Changed when the layout of the pickled classes changes: older files are ignored
+SNAPSHOT_FORMAT = 3
+
+
+def save_snapshot(snapshot: Snapshot, previous: Snapshot | None = None) -> None:
+    """
+    Saves the parsed snapshot, indexes included, for a fast restart.
+    Written to a temporary file and renamed, so a crash never leaves a broken file.
+    """
+    tmp_path = f'{config.snapshot_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((SNAPSHOT_FORMAT, snapshot), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, config.snapshot_path)
+
+
+def load_snapshot() -> Snapshot | None:
+    """ Reads the saved snapshot, memory-mapped. None if there is no usable file. """
+    try:
+        with open(config.snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            snapshot_format, snapshot = pickle.loads(data)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f'Не удалось прочитать сохранённые таблицы: {e}')
+        return None
+
+    if snapshot_format != SNAPSHOT_FORMAT:
+        logger.info('Сохранённые таблицы в старом формате, будут загружены заново')
+        return None
+    return snapshot
+
+
+# Cache of all order sheets. The first load happens during the bot warm-up.
+sheets_cache = SnapshotCache(fetch_sources, ttl=config.orders_cache_ttl)
+sheets_cache.add_listener(save_snapshot)
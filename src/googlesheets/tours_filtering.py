@@ -1,373 +1,180 @@
+import heapq
 import logging
-from datetime import datetime, date
-from difflib import get_close_matches
-from typing import Optional
-
-from environs import Env
-
-from ..googlesheets.docs_parsing import get_brief_columns, get_guides_columns, get_orders, get_extended_columns
-from ..googlesheets.mydocs_parsing import get_m_columns, get_p_columns, get_extra_orders, get_brief_mpcols
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Iterator, Optional
+
+from ..googlesheets.docs_parsing import SHEET_NAME, BRIEF_VIEW, EXTENDED_VIEW, GUIDES_VIEW, get_orders_index
+from ..googlesheets.guides import PERSONAL_SHEETS
+from ..googlesheets.index import DateIndex
+from ..googlesheets.mirror import get_snapshot
+from ..googlesheets.mydocs_parsing import BRIEF_PERSONAL_VIEWS, PERSONAL_VIEWS, get_extra_orders_index
+from ..googlesheets.projection import Projection
+from ..googlesheets.records import OrderRecord
+from ..googlesheets.snapshot import Snapshot
 
 logger = logging.getLogger(__name__)
 
-env = Env()
-env.read_env('.env')
-
-# =================== Constants ===================
-# Guides' ids
-zabava = int(env('ZABAVA'))
-agafya = int(env('AGAFYA'))
-feofaniya = int(env('FEOFANIYA'))
-miroslava = int(env('MIROSLAVA'))
-ulyana = int(env('ULYANA'))
-stesha = int(env('STESHA'))
-andrey = int(env('ANDREY'))
-zavid = int(env('ZAVID'))
-olga = int(env('OLGA'))
-
-
-GUIDES = {
-    zabava: {'name': 'Путятина', 'stage_name': 'Забава'},
-    agafya: {'name': 'Агафья', 'stage_name': 'Ясна'},
-    feofaniya: {'name': 'Маркова', 'stage_name': 'Феофания'},
-    miroslava: {'name': 'Вейкова', 'stage_name': 'Мирослава'},
-    ulyana: {'name': 'Ульяна', 'stage_name': ''},
-    stesha: {'name': 'Анжела', 'stage_name': 'Стеша'},
-    andrey: {'name': 'Андрей', 'stage_name': 'Ондрейка'},
-    zavid: {'name': 'Женя', 'stage_name': 'Мишка'},
-    olga: {'name': 'Ольга', 'stage_name': 'Хавронья'}
-}
-
-
-# =================== Helper functions ===================
-def format_date(str_date: str) -> date:
-    """ Date formation """
-    try:
-        pattern = '%d.%m.%Y'
-        return datetime.strptime(str_date, pattern).date()
-    except (ValueError, TypeError):
-        pass
-
+# A filtered record together with the columns selected for the output
+Tour = tuple[OrderRecord, Projection]
 
-def sort_tours(data: list[dict]) -> tuple[list[dict], list[str]]:
-    """Sorts excursion data by date and time. Skips rows with invalid time and returns them separately."""
-    valid_rows = []
-    invalid_rows = []
+# Tours to output and errors in Time column
+Result = tuple[list[dict], list[str]]
 
-    for row in data:
-        try:
-            date_obj = format_date(row['Дата'])
-            time_str = row.get('Время').strip()
-            # Handle period in Time column
-            time_start = time_str.split('-')[0].strip()
-            if len(time_start.split(':')) == 3:
-                time_start = ':'.join(time_start.split(':')[:2])
 
-            time_obj = datetime.strptime(time_start, '%H:%M')
-            valid_rows.append((date_obj, time_obj, row))
-
-        except Exception:
-            invalid_rows.append(' - '.join([row['Дата'], row['Программа']]))
-
-    # Sort by date and time
-    sorted_valid = [item[2] for item in sorted(valid_rows, key=lambda x: (x[0], x[1]))]
-    return sorted_valid, invalid_rows
-
-
-def guide_mentioned_with_typos(row: dict, guide_id: int) -> bool:
-    """
-    Checks if the guide is mentioned in the row (in the 'Герой' and 'Второй герой' fields),
-    taking into account possible typos.
-    """
-    guide = GUIDES[guide_id]
-    targets = [row.get('Герой', ''), row.get('Второй герой', '')]
-
-    for target in targets:
-        words = target.strip().split()
-        if any(
-                get_close_matches(word, [guide['name'], guide['stage_name']], cutoff=0.7)
-                for word in words
-        ):
-            return True
-    return False
-
-
-# =================== Major filtering ===================
-def filter_data(
-        data: list[dict],
-        columns: list[str],
-        start_date: date,
-        end_date: Optional[date] = None,
-        guide_id: Optional[int] = None
-) -> list[dict]:
-    """
-    Universal function for filtering excursions by date or specific period.
-    Can filter by guide if guide_id is passed.
-    """
-
-    return [
-        {header: info for header, info in row.items() if header in columns and info}
-        for row in data
-        if (date_value := format_date(row.get('Дата')))
-           and start_date <= date_value <= (end_date or start_date)
-           and (
-                   not guide_id
-                   or guide_mentioned_with_typos(row, guide_id)
-           )
-    ]
+# =================== Helper functions ===================
+def source_tours(records: list[OrderRecord], projection: Projection) -> Iterator[Tour]:
+    """ Records of one source with valid time, in the order of the source. """
+    return ((record, projection) for record in records if not record.time_error)
 
 
-def filter_data_from_today(data: list[dict], columns: list[str], guide_id: Optional[int] = None) \
-        -> list[dict]:
+def merge_tours(sources: list[tuple[list[OrderRecord], Projection]]) -> Result:
     """
-    Universal function for filtering all Slavna excursions from today.
-    Can filter by guide if guide_id is passed.
+    Merges records of sources already sorted by date and time, with the precomputed keys.
+    Skips rows with invalid time and returns them separately.
+    Tours starting at the same time keep the order of the sources.
     """
+    invalid_rows = [record.error_text for records, _ in sources for record in records if record.time_error]
 
-    return [
-        {header: info for header, info in row.items() if header in columns and info}
-        for row in data
-        if (date_value := format_date(row.get('Дата')))
-           and date_value >= date.today()
-           and (
-                   not guide_id
-                   or guide_mentioned_with_typos(row, guide_id)
-           )
-    ]
-
+    merged = heapq.merge(*(source_tours(records, projection) for records, projection in sources),
+                         key=lambda tour: tour[0].sort_key)
+    return [projection(record) for record, projection in merged], invalid_rows
 
-# =================== Tripster for guides handling ===================
-def get_tripster_and_slavna_tours(guide: int, slavna_data: list[dict], columns: list[str],
-                                  start_date: Optional[date] = None, end_date: Optional[date] = None,
-                                  from_today: bool = False) -> tuple[list[dict], list[str]]:
-    """
-    Receives excursions from other docs and combines them with Slavna's data for a date or period.
 
-    Args:
-        guide (int): guide ID
-        slavna_data (list[dict]): Main tour data
-        columns (list[str]): Columns for filtering (Slavna's docs)
-        start_date (Optional[date]): Start date of the period
-        end_date (Optional[date]): End date of the period
-        from_today (bool): If True, filter from today.
+# =================== Queries ===================
 
-    Returns:
-        tuple[list[dict], list[str]]: Filtered and combined excursions data and errors in Time column if any
+@dataclass(frozen=True)
+class TourQuery:
     """
-    brief_columns = get_brief_mpcols()
-
-    if guide == feofaniya:
-        tripster_data = get_extra_orders('Маркова')
-        extra_columns = get_m_columns()
-    elif guide == zabava:
-        tripster_data = get_extra_orders('Путятина')
-        extra_columns = get_p_columns()
-    else:
-        return [], []
-
-    if from_today:
-        tripster_tours = filter_data_from_today(tripster_data, brief_columns)
-        slavna_tours = filter_data_from_today(slavna_data, columns, guide_id=guide)
-    else:
-        tripster_columns = brief_columns if end_date else extra_columns
-        tripster_tours = filter_data(tripster_data, tripster_columns, start_date=start_date, end_date=end_date)
-        slavna_tours = filter_data(slavna_data, columns, start_date=start_date, end_date=end_date,
-                                   guide_id=guide)
-    logger.info(f"Slavna: {len(slavna_tours)} tours, Tripster: {len(tripster_tours)} tours.")
-
-    tours, errors = sort_tours(tripster_tours + slavna_tours)
-    return tours, errors
-
+    Tours to show: whose, for which days and in how much detail.
 
-# =================== Condition filtering ===================
-def filter_by_date(due_date: Optional[date] = None, guide: Optional[int] = None) -> tuple[list[dict], list[str]]:
+    A query for a day shows the detailed columns, a query for a period - the brief ones.
+    Without end_date a period lasts up to the end of the sheets.
     """
-    Filters data from Google Sheet by date.
-    Can filter by guide if guide ID is provided.
-    For two guides, also adds data for the date from other Google Sheets.
+    start_date: date = field(default_factory=date.today)
+    end_date: Optional[date] = None
+    guide: Optional[int] = None
+    superadmin: bool = False
+    period: bool = False
 
-    If due_date is provided, filters data for the specified date.
-    Otherwise, filters data for today's date.
-
-    Args:
-       due_date (Optional[date], optional): Date for filtering. If not specified, current date is used
-       guide (Optional[int]): Guide ID for filtering their tours.
-
-    Returns:
-       tuple[list[dict], list[str]]: Filtered data and errors in Time column.
-    """
-    try:
-        logger.debug(f"filter_by_date called: due_date={due_date}, guide={guide}")
-        data = get_orders()
+    @classmethod
+    def for_date(cls, due_date: Optional[date] = None, guide: Optional[int] = None,
+                 superadmin: bool = False) -> 'TourQuery':
+        """ Tours of a day, today by default. """
         tour_date = due_date or date.today()
+        return cls(tour_date, tour_date, guide, superadmin)
+
+    @classmethod
+    def for_period(cls, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                   guide: Optional[int] = None, superadmin: bool = False) -> 'TourQuery':
+        """ Tours of a period. Without both dates - all tours from today. """
+        if start_date and end_date:
+            return cls(start_date, end_date, guide, superadmin, period=True)
+        return cls(date.today(), None, guide, superadmin, period=True)
+
+
+def plan_sources(query: TourQuery, snapshot: Snapshot) -> list[tuple[DateIndex, Projection]]:
+    """
+    Indexes of the sheets the query reads, each with the columns to output.
+    Personal sheets go first: tours starting at the same time keep this order after sorting.
+    """
+    # Personal sheets: all of them for the superadmin, their own for a guide who has one
+    if query.superadmin:
+        extra_sheets = [sheet['name'] for sheet in PERSONAL_SHEETS.values()]
+        # Columns of all the sheets: the same columns of different sheets may have different numbers
+        day_view = sum((PERSONAL_VIEWS[sheet_name] for sheet_name in extra_sheets), ())
+    elif query.guide in PERSONAL_SHEETS:
+        extra_sheets = [PERSONAL_SHEETS[query.guide]['name']]
+        day_view = PERSONAL_VIEWS[extra_sheets[0]]
+    else:
+        extra_sheets, day_view = [], ()
 
-        if guide:
-            columns = get_guides_columns()
-
-            if guide in (feofaniya, zabava):
-                # For Феофания & Забава
-                logger.debug(f"Guide {guide} — branch get_tripster_and_slavna_tours")
-                tours, errors = get_tripster_and_slavna_tours(guide, data, columns, start_date=tour_date)
-                logger.debug(f"get_tripster_and_slavna_tours returns {len(tours)} tours, errors: {len(errors)}")
-                return tours, errors
-
-            # For other guids
-            filtered_data = filter_data(data, columns, tour_date, guide_id=guide)
-            tours, errors = sort_tours(filtered_data)
-            return tours, errors
-
-        # For admins
-        logger.debug("No guide request — admin branch")
-        columns = get_extended_columns()
-        filtered_data = filter_data(data, columns, tour_date)
-        logger.debug(f"filter_data (admin) returns {len(filtered_data)} lines")
-        tours, errors = sort_tours(filtered_data)
-        return tours, errors
-    except Exception as e:
-        logger.exception(f"Ошибка при загрузке или фильтрации данных: guide={guide}, due_date={due_date}")
-        return [], []
-
-
-def filter_by_period(start_date: Optional[date] = None, end_date: Optional[date] = None, guide: Optional[int] = None) \
-        -> tuple[list[dict], list[str]]:
-    """
-    Filters data from Google Sheet for a specified period.
-    Can filter by guide if guide ID is provided.
-    For two guides, also adds data from other Google Sheets.
-
-    If both dates are provided, filters data for the specified period.
-    Otherwise, filters data from the current date to the end of the list.
-
-    Args:
-       guide (int): Guide ID for filtering their tours
-       start_date (Optional[date], optional): Start date for filtering. If not specified, current date is used
-       end_date (Optional[date], optional): End date for filtering. If not specified, end of list is used.
+    sources = [
+        (get_extra_orders_index(sheet_name, snapshot),
+         snapshot.projection(sheet_name, BRIEF_PERSONAL_VIEWS[sheet_name] if query.period else day_view))
+        for sheet_name in extra_sheets
+    ]
 
-    Returns:
-       tuple[list[dict], list[str]]: Filtered data and errors in Time column.
-    """
-    try:
-        # Getting data from a Google sheet
-        data = get_orders()
-        start_date = start_date or date.today()
-
-        if guide:
-            # Selecting the necessary columns (excursions from Slavna)
-            columns = get_brief_columns()
-            # Excursions for a specified period
-            if start_date and end_date:
-                if guide in (feofaniya, zabava):
-                    tours, errors = get_tripster_and_slavna_tours(guide, data, columns, start_date, end_date)
-                    return tours, errors
-                # For other guids
-                filtered_data = filter_data(data, columns, start_date, end_date, guide_id=guide)
-                tours, errors = sort_tours(filtered_data)
-                return tours, errors
-            else:
-                # Filtering data from today
-                if guide in (feofaniya, zabava):
-                    tours, errors = get_tripster_and_slavna_tours(guide, data, columns, from_today=True)
-                    return tours, errors
-                # For other guids
-                filtered_data = filter_data_from_today(data, columns, guide_id=guide)
-                tours, errors = sort_tours(filtered_data)
-                return tours, errors
-        # For admins
-        else:
-            columns = get_brief_columns()
-            # Excursions for a specified period
-            if start_date and end_date:
-                filtered_data = filter_data(data, columns, start_date, end_date)
-                tours, errors = sort_tours(filtered_data)
-                return tours, errors
-            else:
-                # Filtering data from today
-                filtered_data = filter_data_from_today(data, columns)
-                tours, errors = sort_tours(filtered_data)
-                return tours, errors
-    except Exception as e:
-        logger.exception(f'Ошибка при загрузке или фильтрации данных: guide={guide}')
-        return [], []
-
-
-# =================== Super Admin ===================
-def get_data_for_sa(slavna_tours: list[dict],
-                    columns: list[str],
-                    start_date: Optional[date] = None,
-                    end_date: Optional[date] = None,
-                    from_today: bool = False) -> tuple[list[dict], list[str]]:
-    """ Collects tour data from both guides' personal Tripsters and all of Slava's tours"""
-    # Collect data from personal Tripsters
-    tripster_m = get_extra_orders('Маркова')
-    tripster_p = get_extra_orders('Путятина')
-    tripster_data = tripster_m + tripster_p
-
-    # List of all excursions from personal Tripsters
-    if from_today:
-        tripster_tours = filter_data_from_today(tripster_data, columns)
-
-    # List of excursions for a date or a specified period from personal Tripsters
+    # Orders of Slavna: all of them, or the guide's only
+    if query.period:
+        view = BRIEF_VIEW
     else:
-        tripster_tours = filter_data(tripster_data, columns, start_date=start_date, end_date=end_date)
+        view = GUIDES_VIEW if query.guide else EXTENDED_VIEW
+    sources.append((get_orders_index(query.guide, snapshot), snapshot.projection(SHEET_NAME, view)))
+    return sources
 
-    logger.debug(f"Slavna: {len(slavna_tours)} tours, Tripster: {len(tripster_tours)} tours.")
-    tours, errors = sort_tours(tripster_tours + slavna_tours)
-    return tours, errors
 
+# =================== Results cache ===================
 
-def filter_for_sa_date(due_date: Optional[date] = None) -> tuple[list[dict], list[str]]:
+class ResultCache:
     """
-    Filters data from Google Sheet by date for superadmin: combines tours from Slava and two guides.
-
-    If due_date is provided, filters data for the specified date.
-    Otherwise, filters data for today's date.
-
-    Args:
-       due_date (Optional[date], optional): Date for filtering. If not specified, current date is used.
-
-    Returns:
-       Tuple[List[Dict[str, Any]], List[str]]: Filtered data and list of errors if any.
+    LRU cache of query results for the current snapshot. Results of older snapshots
+    are dropped as soon as a newer one is queried. Cached lists are shared by the callers
+    and must not be changed.
     """
 
-    # Columns from personal Tripsters (extended)
-    extra_mcolumns = get_m_columns()
-    extra_pcolumns = get_p_columns()
-    columns = extra_mcolumns + extra_pcolumns
+    def __init__(self, size: int):
+        self.size = size
+        self._results: OrderedDict[TourQuery, Result] = OrderedDict()
+        self._version = 0
+        self._lock = threading.Lock()
 
-    tour_date = due_date if due_date else date.today()
+    def get(self, query: TourQuery, version: int) -> Optional[Result]:
+        with self._lock:
+            if version != self._version or query not in self._results:
+                return None
+            self._results.move_to_end(query)
+            return self._results[query]
 
-    # Excursions from Slavna
-    slavna_tours, slavna_errors = filter_by_date(tour_date)
+    def put(self, query: TourQuery, version: int, result: Result) -> None:
+        with self._lock:
+            if version < self._version:
+                # Computed from a snapshot replaced meanwhile
+                return
+            if version > self._version:
+                self._results.clear()
+                self._version = version
+            self._results[query] = result
+            self._results.move_to_end(query)
+            if len(self._results) > self.size:
+                self._results.popitem(last=False)
 
-    all_tours, errors = get_data_for_sa(slavna_tours, columns, tour_date)
 
-    return all_tours, slavna_errors + errors
+# Results of the current snapshot: e.g. all admins asking about tomorrow after the reminder
+RESULT_CACHE_SIZE = 256
+result_cache = ResultCache(RESULT_CACHE_SIZE)
 
 
-def filter_for_sa_period(start_date: Optional[date] = None, end_date: Optional[date] = None) \
-        -> tuple[list[dict], list[str]]:
+def find_tours(query: TourQuery, snapshot: Optional[Snapshot] = None) -> Result:
     """
-    Filters data from Google Sheet for a specified period for superadmin: combines tours from Slava and two guides.
-
-    If both dates are provided, filters data for the specified period.
-    Otherwise, filters data from the current date to the end of the list.
-
-    Args:
-       start_date (Optional[date], optional): Start date for filtering. If not specified, current date is used
-       end_date (Optional[date], optional): End date for filtering. If not specified, end of list is used.
+    Tours matching the query from one snapshot of all sheets, the current one by default.
+    Queries run together can share a snapshot, so they see the same data.
+    Only rows in the date range of each source are read. The sources are sorted
+    in their indexes, so the tours are merged in one pass without sorting.
+    A repeated query is answered from the cache until the snapshot changes.
 
     Returns:
-       List[Dict[str, Any]]: Filtered data.
+       tuple[list[dict], list[str]]: Filtered data and errors in Time column.
     """
-
-    # Columns from personal Tripsters (brief)
-    columns = get_brief_mpcols()
-
-    # Excursions from Slavna
-    slavna_tours, slavna_errors = filter_by_period(start_date=start_date, end_date=end_date)
-
-    if start_date and end_date:
-        tours, errors = get_data_for_sa(slavna_tours, columns, start_date, end_date)
-        return tours, errors + slavna_errors
-    tours, errors = get_data_for_sa(slavna_tours, columns, date.today(), from_today=True)
-    return tours, errors + slavna_errors
+    try:
+        snapshot = snapshot or get_snapshot()
+        # The local mirror has no version: its results are not cached
+        if snapshot.version and (result := result_cache.get(query, snapshot.version)) is not None:
+            return result
+
+        sources = [
+            (index.between(query.start_date, query.end_date), projection)
+            for index, projection in plan_sources(query, snapshot)
+        ]
+        logger.debug(f"{query}: {sum(len(records) for records, _ in sources)} tours")
+        result = merge_tours(sources)
+
+        if snapshot.version:
+            result_cache.put(query, snapshot.version, result)
+        return result
+    except Exception:
+        # No data at all: an empty list would be shown as 'no excursions'
+        logger.exception(f"Ошибка при загрузке или фильтрации данных: {query}")
+        raise
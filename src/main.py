@@ -10,7 +10,9 @@ from aiogram.fsm.storage.memory import MemoryStorage
 
 from .bot.handlers import extra_handlers, period_handlers, date_handlers, handlers
 from .bot.scheduler import setup_scheduler
+from .bot.write_queue import start_write_worker
 from .config import config
+from .googlesheets.async_sheets import warm_up
 from .logging_config import setup_logging
 
 from aiogram.client.session.aiohttp import AiohttpSession
@@ -37,6 +39,11 @@ async def main():
     dp.include_router(extra_handlers.router)
     dp.include_router(handlers.router)
 
+    # Google Sheets are loaded in the background while the bot is already polling
+    warm_up_task = asyncio.create_task(warm_up())
+    # Records queued by admins, including ones left from before the restart
+    start_write_worker(bot)
+
     try:
         await dp.start_polling(bot, timeout=60)
     except Exception as e:
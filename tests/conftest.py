@@ -0,0 +1,15 @@
+import os
+
+# src.config reads the environment on import
+for name, value in {
+    'BOT_TOKEN': '123456:test',
+    'SUPER_ADMIN': '1',
+    'ADMIN_IDS': '1',
+    'GUIDE_IDS': '1',
+    'GOOGLE_CREDS': 'credentials.json',
+    'EMAIL_HOST': '127.0.0.1',
+    'EMAIL_PORT': '25',
+    'EMAIL_HOST_USER': '',
+    'EMAIL_HOST_PASSWORD': '',
+}.items():
+    os.environ.setdefault(name, value)
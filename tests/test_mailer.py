@@ -0,0 +1,112 @@
+import asyncio
+import socket
+from email.message import EmailMessage
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from src.bot import mailer
+from src.config import config
+
+REJECTED = 'nobody@example.com'
+
+
+class Handler:
+    """ Keeps the received messages and the SMTP sessions they came over. """
+
+    def __init__(self, drop_after: int = 0):
+        self.received: list[str] = []
+        self.sessions = set()
+        # The first connection is dropped after this many messages, without answering the last one
+        self.drop_after = drop_after
+        self.dropped = False
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address == REJECTED:
+            return '550 No such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(session)
+        if self.drop_after and not self.dropped and len(self.received) == self.drop_after - 1:
+            self.dropped = True
+            server.transport.close()
+            return '250 OK'
+        self.received.extend(envelope.rcpt_tos)
+        return '250 OK'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    servers = []
+
+    def start(handler: Handler) -> Handler:
+        controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+        controller.start()
+        servers.append(controller)
+        monkeypatch.setattr(config, 'hostname', controller.hostname)
+        monkeypatch.setattr(config, 'port', controller.port)
+        monkeypatch.setattr(config, 'email_username', None)
+        monkeypatch.setattr(config, 'email_password', None)
+        monkeypatch.setattr(config, 'use_tls', False)
+        return handler
+
+    yield start
+    for controller in servers:
+        controller.stop()
+
+
+def make_messages(addresses: list[str]) -> list[EmailMessage]:
+    messages = []
+    for address in addresses:
+        message = EmailMessage()
+        message['From'] = 'bot@example.com'
+        message['To'] = address
+        message['Subject'] = 'Записи на неделю'
+        message.set_content('Текст')
+        messages.append(message)
+    return messages
+
+
+def test_connections_are_reused(smtp_server):
+    handler = smtp_server(Handler())
+    addresses = [f'guide{i}@example.com' for i in range(10)]
+
+    result = asyncio.run(mailer.send_emails(make_messages(addresses)))
+
+    assert result['sent'] == 10
+    assert result['failed'] == []
+    assert sorted(handler.received) == sorted(addresses)
+    assert len(handler.sessions) <= mailer.POOL_SIZE
+
+
+def test_message_is_sent_again_after_a_dropped_connection(smtp_server, monkeypatch):
+    monkeypatch.setattr(mailer, 'POOL_SIZE', 1)
+    handler = smtp_server(Handler(drop_after=2))
+    addresses = [f'guide{i}@example.com' for i in range(4)]
+
+    result = asyncio.run(mailer.send_emails(make_messages(addresses)))
+
+    assert handler.dropped
+    assert result['sent'] == 4
+    assert result['failed'] == []
+    assert handler.received == addresses
+    assert len(handler.sessions) == 2
+
+
+def test_rejected_recipient_is_reported(smtp_server):
+    handler = smtp_server(Handler())
+    addresses = ['guide1@example.com', REJECTED, 'guide2@example.com']
+
+    result = asyncio.run(mailer.send_emails(make_messages(addresses)))
+
+    assert result['sent'] == 2
+    assert result['failed'] == [REJECTED]
+    assert sorted(handler.received) == ['guide1@example.com', 'guide2@example.com']
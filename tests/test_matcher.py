@@ -0,0 +1,85 @@
+import re
+import time
+from difflib import get_close_matches
+from pathlib import Path
+
+import pytest
+
+from src.googlesheets.matcher import NameMatcher
+
+# The guides as they were hard-coded in tours_filtering
+GUIDES = {
+    1: {'name': 'Путятина', 'stage_name': 'Забава'},
+    2: {'name': 'Агафья', 'stage_name': 'Ясна'},
+    3: {'name': 'Маркова', 'stage_name': 'Феофания'},
+    4: {'name': 'Вейкова', 'stage_name': 'Мирослава'},
+    5: {'name': 'Ульяна', 'stage_name': ''},
+    6: {'name': 'Анжела', 'stage_name': 'Стеша'},
+    7: {'name': 'Андрей', 'stage_name': 'Ондрейка'},
+    8: {'name': 'Женя', 'stage_name': 'Мишка'},
+    9: {'name': 'Ольга', 'stage_name': 'Хавронья'},
+}
+
+# Hero cells with correctly capitalised names, typos and other people's names
+CELLS = (Path(__file__).parent / 'data' / 'guide_cells.txt').read_text(encoding='utf-8').splitlines()
+
+PUNCTUATION = re.compile(r'[^\w\s]')
+
+
+def old_find(text: str) -> frozenset[int]:
+    """ Guides found by guide_mentioned_with_typos before the matcher. """
+    words = text.strip().split()
+    return frozenset(
+        guide_id for guide_id, guide in GUIDES.items()
+        if any(get_close_matches(word, [guide['name'], guide['stage_name']], cutoff=0.7) for word in words)
+    )
+
+
+def test_same_matches_as_get_close_matches():
+    # The old code split cells only by spaces: a comma glued to a word lowered its similarity
+    matcher = NameMatcher(GUIDES)
+    mismatches = [
+        (cell, matcher.find(cell))
+        for cell in CELLS if matcher.find(cell) != old_find(PUNCTUATION.sub(' ', cell))
+    ]
+    assert mismatches == []
+
+
+def test_punctuation_only_adds_matches():
+    matcher = NameMatcher(GUIDES)
+    assert all(old_find(cell) <= matcher.find(cell) for cell in CELLS)
+
+
+@pytest.mark.parametrize('cell, guide_ids', [
+    ('маркова', {3}),
+    ('Путятина/Забава', {1}),
+    ('Ясна,Стеша', {2, 6}),
+    ('Фёофания', {3}),
+])
+def test_normalisation_finds_more(cell, guide_ids):
+    # Lower case, punctuation between names and 'ё' were missed before
+    assert NameMatcher(GUIDES).find(cell) == guide_ids
+
+
+def best_time(run, repeat: int = 3) -> float:
+    """ Shortest of a few runs, so a busy machine doesn't decide the result. """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_order_of_magnitude_faster():
+    def old_run():
+        for cell in CELLS:
+            old_find(cell)
+
+    def new_run():
+        # A new matcher each time: its caches fill during the run, as on the first snapshot after a start
+        matcher = NameMatcher(GUIDES)
+        for cell in CELLS:
+            matcher.find(cell)
+
+    assert best_time(new_run) * 10 <= best_time(old_run)
@@ -0,0 +1,32 @@
+import threading
+import time
+
+import pytest
+
+from src.googlesheets import snapshot
+from src.googlesheets.quota import QuotaLimiter
+
+
+@pytest.fixture
+def limiter(monkeypatch) -> QuotaLimiter:
+    """ Limiter with an empty bucket: a token a second, background calls wait for 16 of them. """
+    limiter = QuotaLimiter(60)
+    limiter._tokens = 0.0
+    monkeypatch.setattr(snapshot, 'limiter', limiter)
+    return limiter
+
+
+def test_reader_raises_priority_of_background_refresh(limiter):
+    cache = snapshot.SnapshotCache(lambda: {'orders': limiter.call(lambda: [{'Программа': 'Тур'}])}, ttl=60)
+    refresh = threading.Thread(target=cache.background_refresh)
+    refresh.start()
+    time.sleep(0.3)
+
+    start = time.monotonic()
+    assert cache.get()['orders'].rows == [{'Программа': 'Тур'}]
+    refresh.join()
+
+    # The refresh waited for one token as an interactive call, not for the background reserve
+    assert time.monotonic() - start < 5
+    assert limiter.stats()['calls_interactive'] == 1
+    assert 'calls_background' not in limiter.stats()